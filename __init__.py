@@ -10,3 +10,9 @@ class ImageOptimizerPlugin(InterfaceActionBase):
     author              = 'Tachibana Shin'
     version             = (1, 0, 1)
     actual_plugin       = 'calibre_plugins.image_optimizer.main:ImageOptimizerAction'
+
+    def cli_main(self, argv):
+        # calibre-debug -r "Image Optimizer" -- LIBRARY [options]
+        import sys
+        from calibre_plugins.image_optimizer.cli import main
+        sys.exit(main(argv[1:]))
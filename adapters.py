@@ -0,0 +1,62 @@
+from collections import Counter
+
+from calibre.utils.localization import _
+
+from .optimizer import optimize_image_logic, estimate_memory
+from .pool import map_ordered
+from .mobi import MobiAdapter
+from .pdf import PdfAdapter
+
+load_translations()  # type: ignore
+
+# zip 以外のフォーマットのアダプター。各アダプターはブックから画像を1つずつ取り出し、
+# zip と同じ optimize_image_logic をワーカープールで実行した結果を、元の順序で書き戻す
+
+ADAPTERS = (MobiAdapter(), PdfAdapter())
+
+class Cancelled(Exception):
+    pass
+
+def find_adapter(fmt, path):
+    for adapter in ADAPTERS:
+        if adapter.matches(fmt, path):
+            return adapter
+    return None
+
+def adapter_params(adapter, params):
+    # フォーマットが埋め込める画像の形式に合わせて出力フォーマットを固定する
+    if getattr(adapter, 'keep_format', False):
+        return dict(params, format=_("Original"))
+    if getattr(adapter, 'output_format', None):
+        return dict(params, format=adapter.output_format)
+    return params
+
+def _optimize(key, data, payload, params):
+    # ワーカースレッドで実行される。data が None の場合は画像ではない
+    counters = Counter()
+    if data is None:
+        return key, None, payload, counters
+    return key, optimize_image_logic(data, params, counters), payload, counters
+
+def _memory(key, data, payload, params):
+    return 0 if data is None else estimate_memory(data, params)
+
+def rewrite(adapter, path, temp_out, params, counters, progress=None, label='', abort=None, budget=None):
+    # 画像を並列に最適化して temp_out に書く。キャンセルされた場合は False。budget はバッチのメモリ予算
+    params = adapter_params(adapter, params)
+
+    def optimize(items):
+        tasks = ((key, data, payload, params) for key, data, payload in items)
+        for key, output, payload, item_counters in map_ordered(_optimize, tasks, params.get('workers'), abort,
+                                                                    weigh=_memory, budget=budget):
+            counters.update(item_counters)
+            yield key, output, payload
+        # 途中で終わった場合は、アダプターが不完全なファイルを書き終える前に中断する
+        if abort is not None and abort.is_set():
+            raise Cancelled()
+
+    try:
+        adapter.rewrite(path, temp_out, optimize, progress, label, counters)
+    except Cancelled:
+        return False
+    return True
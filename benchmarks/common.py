@@ -0,0 +1,98 @@
+import os, sys, io, math, builtins, importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PACKAGE = 'image_optimizer'
+
+def load_plugin(submodule=None, name=PACKAGE):
+    # calibre のプラグインローダーを通さずにモジュールを読み込む（calibre-debug から実行する）
+    builtins.__dict__.setdefault('load_translations', lambda *a, **k: None)
+    if name not in sys.modules:
+        _load_package(name)
+    if submodule:
+        return importlib.import_module('{}.{}'.format(name, submodule))
+    return sys.modules[name]
+
+def _load_package(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def synthetic_image(size, seed=0, mode='RGB'):
+    # 再現可能な合成画像（フラクタル + ノイズ）。スキャン画像に近い高周波成分を含む
+    import random
+    from PIL import Image, ImageChops
+    w, h = size
+    base = Image.effect_mandelbrot((w, h), (-2.0 + (seed % 100) * 0.005, -1.5, 1.0, 1.5), 64 + seed % 64)
+    # Image.effect_noise はシードを指定できないので、乱数列から作る
+    noise = Image.frombytes('L', (w, h), random.Random(seed).randbytes(w * h)).point(lambda v: v // 4)
+    gray = ImageChops.add(base, noise, scale=1.5)
+    if mode == 'L':
+        return gray
+    return Image.merge('RGB', (gray, base, ImageChops.invert(noise)))
+
+def encode(image, fmt='JPEG', **kw):
+    buf = io.BytesIO()
+    image.save(buf, fmt, **kw)
+    return buf.getvalue()
+
+def psnr(a, b):
+    from PIL import ImageChops, ImageStat
+    if a.size != b.size:
+        b = b.resize(a.size)
+    diff = ImageChops.difference(a.convert('RGB'), b.convert('RGB'))
+    mse = sum(v * v for v in ImageStat.Stat(diff).rms) / 3
+    return float('inf') if mse == 0 else 20 * math.log10(255 / math.sqrt(mse))
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def _rss_kb():
+    # 現在の RSS (KB)。/proc がない環境では None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+def run_isolated(func, *args):
+    # 子プロセスで func を実行し、(戻り値, ピークメモリ増分 KB) を返す。
+    # fork できない環境ではこのプロセス内で実行し、メモリは None を返す
+    import pickle, resource
+    if not hasattr(os, 'fork'):
+        return func(*args), None
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 0
+        try:
+            base = _rss_kb()
+            result = func(*args)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == 'darwin':
+                peak //= 1024
+            delta = None if base is None else max(0, peak - base)
+            payload = pickle.dumps((result, delta))
+        except BaseException as e:
+            payload = pickle.dumps(e)
+            status = 1
+        with os.fdopen(w, 'wb') as f:
+            f.write(payload)
+        os._exit(status)
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        payload = f.read()
+    os.waitpid(pid, 0)
+    result = pickle.loads(payload)
+    if isinstance(result, BaseException):
+        raise result
+    return result
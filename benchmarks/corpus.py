@@ -0,0 +1,99 @@
+# ベンチマーク用の合成 EPUB / CBZ コーパスを生成する（オフライン・シード固定で再現可能）
+import os, json, random, hashlib, zipfile
+
+from common import synthetic_image, encode
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua').split()
+
+CONTAINER = ('<?xml version="1.0"?>\n'
+             '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+             '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+             '</rootfiles></container>')
+
+MEDIA_TYPES = {'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp', 'gif': 'image/gif'}
+EXTENSIONS = {'jpeg': 'jpg', 'png': 'png', 'webp': 'webp', 'gif': 'gif'}
+
+def parse_resolutions(value):
+    return [tuple(int(v) for v in part.split('x')) for part in value.split(',') if part]
+
+def image_bytes(rng, seed, resolutions, formats, gray_ratio=0.0):
+    fmt = rng.choice(formats)
+    size = rng.choice(resolutions)
+    mode = 'L' if rng.random() < gray_ratio else 'RGB'
+    image = synthetic_image(size, seed=seed, mode=mode)
+    if fmt == 'jpeg':
+        return fmt, encode(image, 'JPEG', quality=95)
+    if fmt == 'png':
+        return fmt, encode(image, 'PNG')
+    if fmt == 'webp':
+        return fmt, encode(image, 'WEBP', quality=95)
+    return fmt, encode(image.convert('P'), 'GIF')
+
+def xhtml(rng, size):
+    words = []
+    total = 0
+    while total < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        total += len(word) + 1
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><body><p>'
+            + ' '.join(words) + '</p></body></html>')
+
+def build_epub(path, seed, images, resolutions, formats, text_entries, text_size, gray_ratio=0.0):
+    rng = random.Random(seed)
+    manifest = []
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        z.writestr('META-INF/container.xml', CONTAINER, compress_type=zipfile.ZIP_DEFLATED)
+        for i in range(text_entries):
+            name = 'text/chapter{:04d}.xhtml'.format(i)
+            z.writestr('OEBPS/' + name, xhtml(rng, text_size), compress_type=zipfile.ZIP_DEFLATED)
+            manifest.append((name, 'application/xhtml+xml'))
+        z.writestr('OEBPS/style.css', 'body { margin: 0 }\n' * 50, compress_type=zipfile.ZIP_DEFLATED)
+        manifest.append(('style.css', 'text/css'))
+        for i in range(images):
+            fmt, data = image_bytes(rng, seed * 1000 + i, resolutions, formats, gray_ratio)
+            name = 'images/img{:04d}.{}'.format(i, EXTENSIONS[fmt])
+            z.writestr('OEBPS/' + name, data, compress_type=zipfile.ZIP_STORED)
+            manifest.append((name, MEDIA_TYPES[fmt]))
+        items = ''.join('<item id="i{}" href="{}" media-type="{}"/>'.format(n, href, mt)
+                        for n, (href, mt) in enumerate(manifest))
+        opf = ('<?xml version="1.0" encoding="utf-8"?>\n'
+               '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">'
+               '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Benchmark {}</dc:title>'
+               '<dc:identifier id="uid">bench-{}</dc:identifier></metadata>'
+               '<manifest>{}</manifest><spine/></package>').format(seed, seed, items)
+        z.writestr('OEBPS/content.opf', opf, compress_type=zipfile.ZIP_DEFLATED)
+
+def build_cbz(path, seed, images, resolutions, formats, gray_ratio=0.0):
+    rng = random.Random(seed)
+    with zipfile.ZipFile(path, 'w') as z:
+        for i in range(images):
+            fmt, data = image_bytes(rng, seed * 1000 + i, resolutions, formats, gray_ratio)
+            z.writestr('{:04d}.{}'.format(i, EXTENSIONS[fmt]), data, compress_type=zipfile.ZIP_STORED)
+        z.writestr('ComicInfo.xml', '<ComicInfo><Title>Benchmark {}</Title></ComicInfo>'.format(seed),
+                   compress_type=zipfile.ZIP_DEFLATED)
+
+def build_corpus(directory, books=2, images=20, resolutions=((1600, 2400),), formats=('jpeg',),
+                 text_entries=20, text_size=20000, kinds=('epub', 'cbz'), seed=1, gray_ratio=0.0):
+    # 設定ごとにサブディレクトリを分け、同じ設定で生成済みのファイルは再利用する
+    settings = json.dumps([books, images, list(resolutions), list(formats), text_entries, text_size,
+                           list(kinds), seed, gray_ratio])
+    directory = os.path.join(directory, hashlib.sha1(settings.encode('utf-8')).hexdigest()[:12])
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for b in range(books):
+        for kind in kinds:
+            book_seed = seed * 100 + b
+            path = os.path.join(directory, 'book{:03d}.{}'.format(b, kind))
+            if not os.path.exists(path):
+                # 途中で中断しても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+                tmp = path + '.tmp'
+                if kind == 'epub':
+                    build_epub(tmp, book_seed, images, resolutions, formats, text_entries, text_size, gray_ratio)
+                else:
+                    build_cbz(tmp, book_seed, images, resolutions, formats, gray_ratio)
+                os.replace(tmp, path)
+            paths.append((kind.upper(), path))
+    return paths
@@ -0,0 +1,51 @@
+# エンコーダーのキャリブレーションのベンチマーク: インストールされているバックエンドと労力の組み合わせを
+# 合成画像で比較し、自動選択で選ばれる組み合わせを表示する。
+#
+#   calibre-debug benchmarks/encoders.py -- --formats JPEG WEBP PNG --quality 85
+import os, sys, json, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import load_plugin, synthetic_image
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compare the encoder backends on synthetic images')
+    parser.add_argument('--formats', nargs='+', default=['JPEG', 'WEBP', 'PNG'])
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--size', type=int, nargs=2, default=[1080, 1440], help='image size (px)')
+    parser.add_argument('--images', type=int, default=3, help='number of images per format')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv[1:] if argv[:1] == ['--'] else argv)
+
+    encoders = load_plugin('encoders')
+    print('Backends: {}'.format(', '.join(encoders.available_encoders())))
+
+    results = []
+    for fmt in args.formats:
+        fmt = encoders.normalize_format(fmt)
+        images = [synthetic_image(tuple(args.size), seed=seed) for seed in range(args.images)]
+        trials = [encoders.Trial(e, effort) for e, effort in encoders.candidates(images[0], fmt)]
+        for image in images:
+            encoders.measure(image, fmt, args.quality, trials)
+        accepted = encoders.accepted(trials)
+        best = encoders.fastest(trials)
+        baseline = trials[0]
+        print('{} (quality {}):'.format(fmt, args.quality))
+        for t in trials:
+            row = {'format': fmt, 'encoder': t.encoder.name, 'effort': t.effort, 'seconds': t.seconds,
+                   'bytes': t.size, 'ssim': t.ssim, 'failed': t.failed, 'accepted': t in accepted, 'selected': t is best}
+            results.append(row)
+            if t.failed:
+                print('  {:<20} failed'.format(t.label))
+                continue
+            print('  {:<20} {:7.3f}s {:6.2f}x {:9.1f}KB {:+6.1f}% SSIM {:.4f}{}{}'.format(
+                t.label, t.seconds, baseline.seconds / t.seconds if t.seconds else 0, t.size / 1024,
+                (t.size / baseline.size - 1) * 100 if baseline.size else 0, t.ssim,
+                '' if t in accepted else ' (rejected)', ' <- selected' if t is best else ''))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,50 @@
+# 差分実行の回帰チェック: 画素数の上限で元のまま残した画像が、上限を上げた次の実行で
+# 前回の出力から再利用されず、最適化されることを確認する。失敗した場合は終了コード 1
+#
+#   calibre-debug benchmarks/incremental.py
+import os, sys, shutil, zipfile, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import load_plugin
+from corpus import build_cbz
+
+class NullLog:
+    def __call__(self, msg): pass
+    def warning(self, msg): pass
+    def error(self, msg): print(msg, file=sys.stderr)
+
+def optimize(processing, path, params, previous=None):
+    _mi, outputs, _stats, _keep, counters = processing.do_single_optimization(
+        0, params, None, None, {'CBZ': path}, log=NullLog(), previous_formats={'CBZ': previous} if previous else None)
+    return outputs['CBZ'], counters
+
+def main(argv):
+    processing = load_plugin('processing')
+    directory = tempfile.mkdtemp(prefix='image_optimizer_incremental_')
+    try:
+        source = os.path.join(directory, 'source.cbz')
+        build_cbz(source, seed=1, images=2, resolutions=((1600, 2400),), formats=('jpeg',))
+        params = dict(processing.DEFAULT_PARAMS, size='1080', quality='85', cache_size='0', incremental=True)
+
+        # 1回目: 上限 1MP で、すべての画像が元のまま残る
+        first, counters = optimize(processing, source, dict(params, max_megapixels='1'))
+        print('max_megapixels=1: {} too large'.format(counters['too_large']))
+        # 2回目: 上限を上げると、前回の出力を再利用せずに最適化する
+        second, counters = optimize(processing, source, dict(params, max_megapixels='150'), previous=first)
+        print('max_megapixels=150: {} reused, {} too large'.format(counters['reused'], counters['too_large']))
+
+        with zipfile.ZipFile(source) as a, zipfile.ZipFile(second) as b:
+            unchanged = [name for name in a.namelist() if name.endswith('.jpg') and a.read(name) == b.read(name)]
+        for path in (first, second):
+            os.remove(path)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if counters['reused'] or unchanged:
+        print('FAILED: images passed through by the old limit were reused: {}'.format(', '.join(unchanged) or counters['reused']))
+        return 1
+    print('OK')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
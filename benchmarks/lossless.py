@@ -0,0 +1,67 @@
+# 可逆圧縮エンジンのベンチマーク: 線画・グレースケール・パレット・写真・透過の合成画像を
+# 従来の設定（Pillow の compress_level=9）とエンジン（CPU 時間の予算ごと）で PNG にし、
+# サイズと時間を比較する。デコード結果が元と異なる、または従来より大きい場合は終了コード 1
+#
+#   calibre-debug benchmarks/lossless.py -- --budgets 0 0.5 1
+import io, os, sys, json, time, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import load_plugin, synthetic_image, encode
+
+def samples(size):
+    from PIL import Image, ImageDraw
+    photo = synthetic_image(size, seed=1)
+    line_art = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(line_art)
+    w, h = size
+    for i in range(0, w, 24):
+        draw.line([(i, 0), (w - i, h)], fill=('black', 'red', 'navy')[i // 24 % 3], width=3)
+    transparent = line_art.convert('RGBA')
+    transparent.putalpha(Image.linear_gradient('L').resize(size).point(lambda v: 255 if v > 128 else 0))
+    return {
+        'line art': line_art,
+        'gray as RGB': synthetic_image(size, seed=2, mode='L').convert('RGB'),
+        'palette 16': photo.quantize(16),
+        'photo': photo,
+        'binary alpha': transparent,
+    }
+
+def identical(a, b):
+    from PIL import ImageChops
+    return ImageChops.difference(a.convert('RGBA'), b.convert('RGBA')).getbbox() is None
+
+def main(argv):
+    from PIL import Image
+    parser = argparse.ArgumentParser(description='Compare the lossless PNG engine with the previous Pillow settings')
+    parser.add_argument('--size', type=int, nargs=2, default=[1080, 1440], help='image size (px)')
+    parser.add_argument('--budgets', type=float, nargs='+', default=[0.0, 1.0], help='CPU seconds per image')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv[1:] if argv[:1] == ['--'] else argv)
+
+    lossless = load_plugin('lossless')
+    print('NumPy: {}'.format('yes' if lossless.np is not None else 'no'))
+    results, failed = [], False
+    for name, image in samples(tuple(args.size)).items():
+        start = time.perf_counter()
+        baseline = len(encode(image, 'PNG', optimize=True, compress_level=9))
+        baseline_seconds = time.perf_counter() - start
+        print('{} (Pillow z9 {:.1f}KB, {:.3f}s):'.format(name, baseline / 1024, baseline_seconds))
+        for budget in args.budgets:
+            start = time.perf_counter()
+            data, label = lossless.engine.encode(image, 'PNG', budget)
+            seconds = time.perf_counter() - start
+            ok = identical(image, Image.open(io.BytesIO(data)))
+            failed = failed or not ok or len(data) > baseline
+            results.append({'image': name, 'budget': budget, 'label': label, 'bytes': len(data), 'seconds': seconds,
+                            'baseline_bytes': baseline, 'baseline_seconds': baseline_seconds, 'lossless': ok})
+            print('  budget {:4.1f}s {:<24} {:9.1f}KB {:+6.1f}% {:7.3f}s{}'.format(
+                budget, label, len(data) / 1024, (len(data) / baseline - 1) * 100, seconds,
+                '' if ok else ' (NOT LOSSLESS)'))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,61 @@
+# 1枚あたりのメモリ上限のベンチマーク: 巨大な画像を最適化したときのピークメモリ増分が、
+# image_memory の設定（+ 入出力のバイト列）に収まることを確認する。
+#
+#   calibre-debug benchmarks/memory.py -- --budget 256 --sources 6000 12000
+#
+# 上限を超えた場合は終了コード 1 を返す。
+import os, sys, json, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import load_plugin, synthetic_image, encode, run_isolated
+
+# ピクセルバッファ以外の増分（Pillow のデコーダー・エンコーダーの作業領域など）の許容量
+SLACK_KB = 48 * 1024
+
+def optimize(data, params):
+    from collections import Counter
+    counters = Counter()
+    output = load_plugin('optimizer').encode_image(data, params, counters)
+    return len(output), dict(counters)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Check the peak memory of optimizing huge images')
+    parser.add_argument('--budget', type=int, default=256, help='image_memory setting (MB)')
+    parser.add_argument('--max-megapixels', type=int, default=150, help='max_megapixels setting')
+    parser.add_argument('--sources', type=int, nargs='+', default=[6000, 12000], help='long side of the synthetic scans (px)')
+    parser.add_argument('--formats', nargs='+', default=['JPEG', 'PNG'])
+    parser.add_argument('--size', default='1080', help='size setting')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv[1:] if argv[:1] == ['--'] else argv)
+
+    load_plugin('optimizer')
+    params = {'size': args.size, 'quality': '85', 'format': 'Original', 'cache_size': '0',
+              'image_memory': str(args.budget), 'max_megapixels': str(args.max_megapixels)}
+
+    results = []
+    for long_side in args.sources:
+        # 大きな合成画像は小さく作って拡大する（生成のメモリを測定に含めない）
+        source = synthetic_image((1500, 2000), seed=long_side).resize((long_side * 3 // 4, long_side))
+        for fmt in args.formats:
+            data = encode(source, fmt, **({'quality': 92} if fmt == 'JPEG' else {'compress_level': 1}))
+            (out_size, counters), peak_kb = run_isolated(optimize, data, params)
+            limit_kb = args.budget * 1024 + (len(data) + out_size) // 1024 + SLACK_KB
+            row = {'source': long_side, 'format': fmt, 'input': len(data), 'output': out_size,
+                   'peak_kb': peak_kb, 'limit_kb': limit_kb, 'counters': counters,
+                   'within_budget': peak_kb is None or peak_kb <= limit_kb}
+            results.append(row)
+            print('{} {}px: {:.1f}MB -> {:.1f}MB, peak {}, limit {:.0f}MB{}{}'.format(
+                fmt, long_side, len(data) / 1048576, out_size / 1048576,
+                'n/a' if peak_kb is None else '{:.0f}MB'.format(peak_kb / 1024), limit_kb / 1024,
+                ' (kept original)' if counters.get('too_large') else '',
+                '' if row['within_budget'] else ' (OVER BUDGET)'))
+            del data
+        del source
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(r['within_budget'] for r in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
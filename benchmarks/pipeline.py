@@ -0,0 +1,141 @@
+# 最適化パイプライン全体のベンチマーク。合成 EPUB / CBZ コーパスを calibre の GUI なしで処理し、
+# images/sec・MB/sec・画像フォーマットごとのレイテンシのパーセンタイル・ピーク RSS を JSON で出力する。
+#
+#   calibre-debug benchmarks/pipeline.py -- --books 2 --images 30 --json result.json
+#   calibre-debug benchmarks/pipeline.py -- --baseline result.json
+import os, sys, json, time, argparse, tempfile, platform
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import load_plugin, percentile
+from corpus import build_corpus, parse_resolutions
+
+# ベースラインとの比較で許容する劣化率
+DEFAULT_TOLERANCE = 0.10
+
+class NullLog:
+    def __call__(self, msg): pass
+    def warning(self, msg): pass
+    def error(self, msg): print(msg, file=sys.stderr)
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def instrument(processing, latencies):
+    # 画像エントリごとの処理時間を記録する（ワーカースレッドから呼ばれる）
+    original = processing.optimize_entry
+    get_image_type = processing.get_image_type
+
+    def timed(item, data, params):
+        start = time.perf_counter()
+        result = original(item, data, params)
+        if data is not None:
+            latencies[get_image_type(data) or 'unknown'].append(time.perf_counter() - start)
+        return result
+
+    processing.optimize_entry = timed
+    return original
+
+def run(args):
+    processing = load_plugin('processing')
+    corpus = build_corpus(args.corpus_dir, books=args.books, images=args.images,
+                          resolutions=parse_resolutions(args.resolutions), formats=args.formats.split(','),
+                          text_entries=args.text_entries, text_size=args.text_size,
+                          kinds=args.kinds.split(','), seed=args.seed, gray_ratio=args.gray_ratio)
+    params = dict(processing.DEFAULT_PARAMS)
+    params.update({'size': str(args.size), 'quality': str(args.quality), 'format': args.format or params['format'],
+                   'workers': str(args.workers), 'cache_size': '0', 'incremental': False})
+
+    latencies = defaultdict(list)
+    original = instrument(processing, latencies)
+    per_kind = defaultdict(lambda: {'books': 0, 'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0})
+    try:
+        start = time.perf_counter()
+        for kind, path in corpus:
+            t = time.perf_counter()
+            _mi, outputs, stats, _keep, _counters = processing.do_single_optimization(
+                0, params, None, None, {kind: path}, log=NullLog())
+            row = per_kind[kind]
+            row['books'] += 1
+            row['seconds'] += time.perf_counter() - t
+            old, new = stats.get(kind, (os.path.getsize(path), 0))
+            row['bytes_in'] += old
+            row['bytes_out'] += new
+            for p in outputs.values():
+                os.remove(p)
+        elapsed = time.perf_counter() - start
+    finally:
+        processing.optimize_entry = original
+
+    images = sum(len(v) for v in latencies.values())
+    bytes_in = sum(r['bytes_in'] for r in per_kind.values())
+    result = {
+        'settings': {k: v for k, v in vars(args).items() if k not in ('json', 'baseline', 'corpus_dir')},
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'seconds': elapsed,
+        'images': images,
+        'images_per_sec': images / elapsed if elapsed else 0.0,
+        'mb_per_sec': bytes_in / (1024 * 1024) / elapsed if elapsed else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+        'books': {kind: dict(row, mb_per_sec=row['bytes_in'] / (1024 * 1024) / row['seconds'] if row['seconds'] else 0.0)
+                  for kind, row in per_kind.items()},
+        'latency_ms': {fmt: {'count': len(v), 'p50': percentile(v, 50) * 1000, 'p90': percentile(v, 90) * 1000,
+                             'p99': percentile(v, 99) * 1000, 'max': max(v) * 1000}
+                       for fmt, v in latencies.items()},
+    }
+    return result
+
+def compare(result, baseline, tolerance):
+    # スループットが tolerance 以上低下した、またはレイテンシが tolerance 以上増加した指標を返す
+    regressions = []
+    for key in ('images_per_sec', 'mb_per_sec'):
+        old, new = baseline.get(key), result.get(key)
+        if old and new is not None and new < old * (1 - tolerance):
+            regressions.append('{}: {:.2f} -> {:.2f}'.format(key, old, new))
+    for fmt, row in result['latency_ms'].items():
+        old = baseline.get('latency_ms', {}).get(fmt)
+        if old and row['p50'] > old['p50'] * (1 + tolerance):
+            regressions.append('latency_ms.{}.p50: {:.1f} -> {:.1f}'.format(fmt, old['p50'], row['p50']))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the optimizer pipeline on a synthetic corpus')
+    parser.add_argument('--books', type=int, default=2, help='books per kind')
+    parser.add_argument('--images', type=int, default=20, help='images per book')
+    parser.add_argument('--resolutions', default='1600x2400,1200x1600', help='comma separated WxH list')
+    parser.add_argument('--formats', default='jpeg,png', help='source image formats (jpeg,png,webp,gif)')
+    parser.add_argument('--gray-ratio', type=float, default=0.0, help='share of grayscale images')
+    parser.add_argument('--text-entries', type=int, default=20, help='XHTML entries per EPUB')
+    parser.add_argument('--text-size', type=int, default=20000, help='bytes per XHTML entry')
+    parser.add_argument('--kinds', default='epub,cbz')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--size', type=int, default=1080)
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--format', default='', help='output format (default: keep the original)')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'image_optimizer_bench'))
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with a previously saved result')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv[1:] if argv[:1] == ['--'] else argv)
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+# 縮小パスのベンチマーク: フル解像度デコード + LANCZOS（従来）と、
+# JPEG ドラフトデコード + 整数 reduce + LANCZOS（optimizer.downscale）を比較する。
+#
+#   calibre-debug benchmarks/resize.py -- --source 4000 --targets 1080 400
+#
+# 画質の許容範囲: 従来の出力に対する PSNR が 40 dB 以上であること。
+import os, sys, time, json, argparse, statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import load_plugin, synthetic_image, encode, psnr, run_isolated
+
+TOLERANCE_PSNR = 40.0
+
+def target_size(size, max_px):
+    # optimizer と同じく短辺を max_px に合わせる
+    w, h = size
+    if w < h:
+        return int(max_px), int(h * (max_px / w))
+    return int(w * (max_px / h)), int(max_px)
+
+def legacy(data, max_px):
+    import io
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    image = image.resize(target_size(image.size, max_px), Image.Resampling.LANCZOS)
+    return image
+
+def reduced(data, max_px):
+    import io
+    from PIL import Image
+    downscale = load_plugin('optimizer').downscale
+    image = Image.open(io.BytesIO(data))
+    return downscale(image, target_size(image.size, max_px))
+
+def timed(func, data, max_px, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = func(data, max_px)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), encode(image, 'PNG', compress_level=1)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the reduce-on-decode resize path')
+    parser.add_argument('--source', type=int, default=4000, help='long side of the synthetic scan (px)')
+    parser.add_argument('--targets', type=int, nargs='+', default=[1080, 400], help='values of the size setting')
+    parser.add_argument('--quality', type=int, default=92, help='JPEG quality of the synthetic source')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv[1:] if argv[:1] == ['--'] else argv)
+
+    import io
+    from PIL import Image
+    load_plugin('optimizer')
+    source = synthetic_image((args.source * 3 // 4, args.source))
+    data = encode(source, 'JPEG', quality=args.quality)
+    del source
+
+    results = []
+    for max_px in args.targets:
+        row = {'source': args.source, 'size': max_px}
+        outputs = {}
+        for name, func in (('legacy', legacy), ('reduced', reduced)):
+            (seconds, png), peak_kb = run_isolated(timed, func, data, max_px, args.repeat)
+            outputs[name] = Image.open(io.BytesIO(png))
+            row[name] = {'seconds': seconds, 'peak_kb': peak_kb}
+        row['speedup'] = row['legacy']['seconds'] / row['reduced']['seconds']
+        row['psnr'] = psnr(outputs['legacy'], outputs['reduced'])
+        row['within_tolerance'] = row['psnr'] >= TOLERANCE_PSNR
+        results.append(row)
+
+        fmt_kb = lambda v: 'n/a' if v is None else '{:.0f}MB'.format(v / 1024)
+        print('{}px -> {}px: legacy {:.3f}s / {}, reduced {:.3f}s / {}, x{:.2f}, PSNR {:.1f}dB{}'.format(
+            args.source, max_px,
+            row['legacy']['seconds'], fmt_kb(row['legacy']['peak_kb']),
+            row['reduced']['seconds'], fmt_kb(row['reduced']['peak_kb']),
+            row['speedup'], row['psnr'], '' if row['within_tolerance'] else ' (OUT OF TOLERANCE)'))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(r['within_tolerance'] for r in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,9 +5,29 @@ def create_plugin_zip():
     output_filename = 'image_optimizer.zip'
     files_to_include = [
         '__init__.py',
+        'adapters.py',
+        'cache.py',
+        'classify.py',
+        'cli.py',
         'config_dialog.py',
+        'encoders.py',
+        'estimate.py',
+        'grayscale.py',
+        'ingest.py',
         'main.py',
+        'lossless.py',
+        'manifest.py',
+        'metadata.py',
+        'mobi.py',
         'optimizer.py',
+        'pdf.py',
+        'pool.py',
+        'processing.py',
+        'progress.py',
+        'quality.py',
+        'scheduler.py',
+        'timing.py',
+        'zipstream.py',
         'plugin-import-name-image_optimizer.txt'
     ]
     
@@ -58,7 +58,7 @@ msgstr ""
 
 if __name__ == "__main__":
     files = []
-    exclude_dirs = {'__pycache__', 'builder', '.git', '.qodo', '.idea', '.vscode'}
+    exclude_dirs = {'__pycache__', 'builder', 'benchmarks', '.git', '.qodo', '.idea', '.vscode'}
     for root, dirs, filenames in os.walk('.'):
         dirs[:] = [d for d in dirs if d not in exclude_dirs]
         for filename in filenames:
@@ -0,0 +1,229 @@
+import os, json, time, struct, hashlib, threading, tempfile
+from collections import Counter, OrderedDict
+
+from calibre.constants import cache_dir
+from calibre.utils.localization import _
+
+load_translations()  # type: ignore
+
+# 最適化ロジックの出力が変わる場合はこの値を上げて古いキャッシュを無効化する
+CACHE_VERSION = 6
+
+# キャッシュキーに含めるパラメータ（出力に影響するもののみ）
+# 上限を超えて元のまま残す画像も出力に含まれるので、画素数とメモリの上限も加える
+CACHE_PARAM_KEYS = ('size', 'quality', 'format', 'grayscale_threshold', 'encoder', 'lossless_budget',
+                    'max_megapixels', 'image_memory')
+# 品質の探索モードの場合のみ追加する（固定品質のキーは以前と同じにする）
+SEARCH_PARAM_KEYS = ('quality_mode', 'target_ssim', 'target_kb')
+
+# 各エントリの先頭に保存するヘッダー（元のエンコードにかかった秒数と、続く結果のカウンター（JSON）の長さ）
+_HEADER = struct.Struct('<dI')
+# ヒット時にも加える、出力の内容を表すカウンター（エンコーダー・色の変換・可逆圧縮・品質の探索結果）。
+# 試しのエンコードやキャリブレーションなど、実際に行った処理の回数は加えない
+RESULT_COUNTERS = ('grayscale', 'bilevel', 'lossless_palette', 'lossless_gray', 'animated',
+                   'quality_searches', 'quality_sum')
+RESULT_PREFIXES = ('encoder:',)
+
+def result_counters(counters):
+    return {key: value for key, value in counters.items()
+            if value and (key in RESULT_COUNTERS or key.startswith(RESULT_PREFIXES))}
+
+def normalize_params(params):
+    norm = {}
+    for key in CACHE_PARAM_KEYS:
+        value = params.get(key)
+        if isinstance(value, str):
+            value = value.strip()
+        if key == 'format':
+            # "Original" は翻訳されるため、言語に依存しない値に変換する
+            value = None if not value or value == _("Original") else value.upper()
+        elif key in ('size', 'quality', 'grayscale_threshold'):
+            try:
+                value = int(float(value))
+            except (TypeError, ValueError):
+                value = None
+        elif key == 'encoder':
+            value = (value or 'auto').lower()
+        elif key in ('lossless_budget', 'max_megapixels', 'image_memory'):
+            try:
+                value = max(0.0, float(value))
+            except (TypeError, ValueError):
+                value = None
+        norm[key] = value
+    mode = params.get('quality_mode')
+    if mode and mode != 'fixed':
+        for key in SEARCH_PARAM_KEYS:
+            value = params.get(key)
+            norm[key] = value.strip() if isinstance(value, str) else value
+    return norm
+
+def params_key(params):
+    # 出力に影響するパラメータとキャッシュバージョンのハッシュ
+    raw = json.dumps([CACHE_VERSION, normalize_params(params)], sort_keys=True).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()
+
+def cache_key(data, params):
+    h = hashlib.sha256()
+    h.update(params_key(params).encode('ascii'))
+    h.update(hashlib.sha256(data).digest())
+    return h.hexdigest()
+
+class ImageCache:
+    # 入力バイトのハッシュ + パラメータをキーとするディスクキャッシュ（LRU で容量を制限）
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None  # key -> サイズ（古い順）
+        self._total = 0
+        # 同じキーを同時にエンコードしないよう、処理中のキーを待ち合わせる
+        self._inflight = {}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        entries = []
+        if os.path.isdir(self.directory):
+            for sub in os.scandir(self.directory):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+        entries.sort()
+        self._index = OrderedDict((name, size) for _mtime, name, size in entries)
+        self._total = sum(self._index.values())
+
+    def get(self, key):
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            # mtime を LRU の順序として使うので、ヒット時に更新する
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self._total -= self._index.pop(key, 0)
+            return None
+        if len(raw) < _HEADER.size:
+            return None
+        seconds, length = _HEADER.unpack_from(raw)
+        start = _HEADER.size + length
+        try:
+            replay = json.loads(raw[_HEADER.size:start].decode('utf-8')) if length else {}
+        except ValueError:
+            return None
+        return raw[start:], seconds, replay
+
+    def put(self, key, data, seconds, replay=None):
+        extra = json.dumps(replay, sort_keys=True).encode('utf-8') if replay else b''
+        size = _HEADER.size + len(extra) + len(data)
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(seconds, len(extra)))
+                f.write(extra)
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            self._load_index()
+            self._total += size - self._index.pop(key, 0)
+            self._index[key] = size
+            self._evict()
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def fetch(self, data, params, compute, counters=None):
+        key = cache_key(data, params)
+        while True:
+            with self._lock:
+                waiter = self._inflight.get(key)
+                if waiter is None:
+                    self._inflight[key] = threading.Event()
+                    break
+            # 同じアーカイブ内の重複画像は最初のエンコード結果を待って再利用する
+            waiter.wait()
+            cached = self.get(key)
+            if cached is not None:
+                return self._hit(data, cached, counters)
+
+        try:
+            cached = self.get(key)
+            if cached is not None:
+                return self._hit(data, cached, counters)
+            local = Counter()
+            start = time.perf_counter()
+            result = compute(data, params, local)
+            seconds = time.perf_counter() - start
+            if not local['skipped'] and not local['too_large']:
+                local['cache_misses'] += 1
+            if counters is not None:
+                counters.update(local)
+            if result is not data:
+                self.put(key, result, seconds, result_counters(local))
+            elif local['kept_original']:
+                # 元のデータを残すという結果は空のペイロードとして記録する
+                self.put(key, b'', seconds, result_counters(local))
+            # スキップやエラーで元データが返された場合はキャッシュしない
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key).set()
+
+    def _hit(self, data, cached, counters):
+        result, seconds, replay = cached
+        if counters is not None:
+            counters['cache_hits'] += 1
+            counters['cache_saved_seconds'] += seconds
+            if not result:
+                counters['kept_original'] += 1
+            # 元のエンコードで数えた結果のカウンターを加え、レポートの内訳をヒットを含めた枚数にする
+            counters.update(replay)
+        return result or data
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache(size_mb):
+    # size_mb は MB 単位。0 または空の場合はキャッシュを無効にする
+    global _cache
+    try:
+        max_bytes = int(float(size_mb) * 1024 * 1024)
+    except (TypeError, ValueError):
+        max_bytes = 0
+    if max_bytes <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ImageCache(os.path.join(cache_dir(), 'image_optimizer'), max_bytes)
+        elif _cache.max_bytes != max_bytes:
+            with _cache._lock:
+                _cache.max_bytes = max_bytes
+                if _cache._index is not None:
+                    _cache._evict()
+        return _cache
@@ -0,0 +1,69 @@
+import posixpath
+from urllib.parse import unquote
+
+from calibre.utils.xml_parse import safe_xml_fromstring
+
+# エントリを解凍せずに画像かどうかを判定する。
+# EPUB は OPF マニフェストの media-type、次に拡張子が画像を示す場合は読まずに画像とし、
+# それ以外は先頭の数バイトを読んで判定する（拡張子がない・間違っているファイルに対応するため）
+
+CONTAINER_NAME = 'META-INF/container.xml'
+
+# 最適化できるラスター画像の拡張子と media-type
+IMAGE_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.jpe', '.jfif', '.png', '.gif', '.webp', '.bmp', '.dib', '.tif', '.tiff',
+    '.ico', '.cur', '.avif', '.qoi', '.hdr', '.exr', '.dds', '.ff', '.pbm', '.pgm', '.ppm', '.pnm',
+))
+IMAGE_MEDIA_TYPES = frozenset((
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff',
+    'image/x-icon', 'image/vnd.microsoft.icon', 'image/avif',
+))
+
+def _iter_local(root, name):
+    # 名前空間に関係なくローカル名で要素を探す
+    for el in root.iter():
+        if isinstance(el.tag, str) and el.tag.rpartition('}')[2] == name:
+            yield el
+
+def opf_path(yin):
+    # container.xml から OPF のパスを取得する（EPUB 以外は None）
+    try:
+        root = safe_xml_fromstring(yin.read(CONTAINER_NAME))
+    except Exception:
+        return None
+    for rootfile in _iter_local(root, 'rootfile'):
+        path = rootfile.get('full-path')
+        if path and (rootfile.get('media-type') or 'application/oebps-package+xml') == 'application/oebps-package+xml':
+            return path
+    return None
+
+def opf_media_types(yin):
+    # {zip 内のパス: media-type}。OPF がない・壊れている場合は空
+    path = opf_path(yin)
+    if not path:
+        return {}
+    try:
+        root = safe_xml_fromstring(yin.read(path))
+    except Exception:
+        return {}
+    base = posixpath.dirname(path)
+    media_types = {}
+    for item in _iter_local(root, 'item'):
+        href, media_type = item.get('href'), item.get('media-type')
+        if href and media_type:
+            name = posixpath.normpath(posixpath.join(base, unquote(href.partition('#')[0])))
+            media_types[name] = media_type.strip().lower()
+    return media_types
+
+class EntryClassifier:
+    def __init__(self, yin):
+        self.media_types = opf_media_types(yin)
+
+    def classify(self, item):
+        # True = 画像、None = 先頭のバイトで判定する。画像ではない拡張子や media-type でも、
+        # 中身が画像のこともある（名前を間違えたファイル）ので、読まずに画像以外とは判定しない
+        media_type = self.media_types.get(item.filename)
+        ext = posixpath.splitext(item.filename)[1].lower()
+        if media_type in IMAGE_MEDIA_TYPES or ext in IMAGE_EXTENSIONS:
+            return True
+        return None
@@ -0,0 +1,221 @@
+import os, sys, signal, argparse, threading, json
+from collections import Counter
+
+from calibre.utils.localization import _
+
+from .processing import DEFAULT_PARAMS, run_batch
+from .timing import format_lines, to_json
+from .encoders import ENCODER_CHOICES, encoder_lines
+from .estimate import estimate_books, estimate_summary, estimate_lines
+
+load_translations()  # type: ignore
+
+# GUI なしでライブラリ全体を最適化する:
+#   calibre-debug -r "Image Optimizer" -- /path/to/library --search "formats:cbz" --journal run.journal
+
+USAGE = '%(prog)s LIBRARY [options]'
+
+class Journal:
+    # 完了したブック ID を1行ずつ追記する。中断しても次回はその続きから再開できる。
+    # 出力がなかった・見積もりで除いたブックは新しい ID を空にして記録する（どちらも完了として扱う）
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.params = None
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith('#params '):
+                        self.params = json.loads(line[len('#params '):])
+                    elif line and not line.startswith('#'):
+                        self.done.add(int(line.split('\t')[0]))
+
+    def start(self, params):
+        if self.params is None:
+            self._append('#params ' + json.dumps(params, sort_keys=True))
+            self.params = params
+
+    def record(self, book_id, new_id=None):
+        with self._lock:
+            self._append('{}\t{}'.format(book_id, '' if new_id is None else new_id))
+            self.done.add(book_id)
+
+    def _append(self, line):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+class ConsoleLog:
+    # ThreadedJob のログと同じインターフェース（複数スレッドから呼ばれる）
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self._lock = threading.Lock()
+
+    def _print(self, msg, stream):
+        with self._lock:
+            print(msg, file=stream, flush=True)
+
+    def __call__(self, msg):
+        if self.verbose: self._print(msg, sys.stdout)
+
+    def warning(self, msg):
+        self._print(msg, sys.stderr)
+
+    def error(self, msg):
+        self._print(msg, sys.stderr)
+
+class ConsoleProgress:
+    # 進行状況を 1% 単位で表示する
+    def __init__(self, log):
+        self.log = log
+        self.last = -1
+
+    def put(self, update):
+        fraction, message = update
+        percent = int(fraction * 100)
+        if percent != self.last:
+            self.last = percent
+            self.log('[{:3d}%] {}'.format(percent, message))
+
+def option_parser():
+    parser = argparse.ArgumentParser(prog='image_optimizer', usage=USAGE,
+        description='Optimize the images of books in a calibre library without the GUI. '
+                    'Optimized copies are added as new books, like the toolbar action does.')
+    parser.add_argument('library', help='path to the calibre library')
+    parser.add_argument('--search', default='', help='calibre search expression selecting the books (default: all books)')
+    parser.add_argument('--ids', default='', help='comma separated book ids (combined with --search)')
+    parser.add_argument('--journal', help='checkpoint journal; completed book ids are skipped when resuming')
+    for key, help in (
+        ('size', 'max size in px of the shorter side'),
+        ('quality', 'compression quality (1-100)'),
+        ('format', 'output format, e.g. JPEG or WEBP (default: keep the original format)'),
+        ('quality_mode', 'fixed, ssim (lowest quality reaching --target-ssim) or size (highest quality within --target-kb); '
+                         '--quality is the upper bound of the search'),
+        ('target_ssim', 'SSIM floor for --quality-mode ssim, e.g. 0.95'),
+        ('target_kb', 'per image size budget in KB for --quality-mode size'),
+        ('grayscale_threshold', 'max R/G/B difference for converting an image to grayscale (0 = disabled)'),
+        ('encoder', 'encoder backend: auto (fastest backend and effort matching the Pillow output, calibrated '
+                    'on the first images of each format) or one of ' + ', '.join(ENCODER_CHOICES[1:])),
+        ('lossless_budget', 'CPU seconds per PNG/GIF image for trying lossless palette, filter and zlib strategies '
+                            'with --encoder auto (0 = disabled)'),
+        ('workers', 'image worker threads (0 = automatic)'),
+        ('cache_size', 'image cache size in MB (0 = disabled)'),
+        ('books_in_flight', 'number of books processed in parallel'),
+        ('memory_budget', 'memory budget in MB for images being processed (0 = unlimited)'),
+        ('disk_budget', 'temporary disk budget in MB (0 = unlimited)'),
+        ('min_savings', 'skip books whose projected savings (estimated from sampled images) are below this percentage'),
+        ('image_memory', 'memory limit in MB for decoding and resizing a single image (0 = unlimited)'),
+        ('max_megapixels', 'images larger than this are kept unchanged (0 = unlimited)'),
+    ):
+        parser.add_argument('--' + key.replace('_', '-'), dest=key, help=help)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only estimate the savings and run time from sampled images; nothing is written to the library')
+    parser.add_argument('--full', action='store_true',
+                        help='re-encode every image instead of reusing unchanged ones from the previous optimized copy')
+    parser.add_argument('--reset-import-time', action='store_true',
+                        help='use the current time as the date of the new books')
+    parser.add_argument('--timings', metavar='FILE',
+                        help='record per-stage timings and write the batch totals to FILE as JSON')
+    parser.add_argument('--quiet', action='store_true', help='only print errors and the summary')
+    return parser
+
+def build_params(args):
+    params = dict(DEFAULT_PARAMS)
+    for key in DEFAULT_PARAMS:
+        value = getattr(args, key, None)
+        if value is not None:
+            params[key] = value
+    params['keep_time_import'] = not args.reset_import_time
+    params['incremental'] = not args.full
+    params['timings'] = bool(args.timings)
+    params['dry_run'] = args.dry_run
+    return params
+
+def select_books(db, args):
+    ids = set(db.search(args.search)) if args.search or not args.ids else set()
+    for part in args.ids.split(','):
+        if part.strip():
+            ids.add(int(part))
+    return sorted(ids)
+
+def main(argv):
+    args = option_parser().parse_args(argv)
+
+    from calibre.library import db as open_library
+    db = open_library(os.path.abspath(args.library)).new_api
+
+    params = build_params(args)
+    log = ConsoleLog(verbose=not args.quiet)
+    journal = Journal(args.journal) if args.journal else None
+    book_ids = select_books(db, args)
+
+    if args.dry_run:
+        log(_("Estimating savings for {} books").format(len(book_ids)))
+        estimates, totals = estimate_books(book_ids, params, db, log=log)
+        for line in estimate_lines(estimates):
+            log(line)
+        print(estimate_summary(totals))
+        return 0
+
+    if journal is not None:
+        if journal.params is not None and journal.params != params:
+            log.warning(_("Journal {} was written with different settings").format(args.journal))
+        journal.start(params)
+        book_ids = [i for i in book_ids if i not in journal.done]
+    log(_("Optimizing {} books").format(len(book_ids)))
+
+    totals = {'books': 0, 'old': 0, 'new': 0}
+    batch_counters = Counter()
+
+    def on_batch_done(batch):
+        # 取り込みスレッドから呼ばれる。ライブラリに追加し終えたブックだけをジャーナルに記録する
+        for book_id, new_id, result, error in batch:
+            mi, optimized_formats, stats, keep_time_import, counters = result
+            batch_counters.update(counters)
+            if new_id is not None:
+                for fmt in optimized_formats:
+                    old_sz, new_sz = stats.get(fmt, (0, 0))
+                    totals['old'] += old_sz
+                    totals['new'] += new_sz
+                totals['books'] += 1
+            # 取り込みに失敗したブックは記録しない（次回やり直す）。出力がなかったブックは new_id なしで記録し、
+            # キャンセル後に追加し終えたブックも記録する（キャンセルで途中まで処理したブックはここに来ない）
+            if journal is not None and error is None:
+                journal.record(book_id, new_id)
+
+    def on_skipped(skipped):
+        # 推定削減率が小さくて除いたブックも完了として記録する（次回は見積もり直さない）
+        if journal is not None:
+            for book_id in skipped:
+                journal.record(book_id)
+
+    # Ctrl+C で処理中のブックを中断し、完了済みのものはジャーナルに残す
+    abort = threading.Event()
+    previous = signal.signal(signal.SIGINT, lambda *a: abort.set())
+    try:
+        failed = run_batch(book_ids, params, db, on_batch_done, abort=abort, log=log,
+                           notifications=None if args.quiet else ConsoleProgress(log), on_skipped=on_skipped)
+    except OSError as e:
+        # 空き容量の事前確認に失敗した場合など
+        log.error(str(e))
+        return 1
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+    reduction = ((totals['old'] - totals['new']) / totals['old']) * 100 if totals['old'] else 0
+    print(_("Optimized {} books.").format(totals['books']), _("Reduced {:.1f}%").format(reduction))
+    if any(key.startswith('encoder:') for key in batch_counters):
+        log(_("Encoders: {}").format(', '.join(encoder_lines(batch_counters))))
+    if args.timings:
+        for line in format_lines(batch_counters):
+            log(line)
+        with open(args.timings, 'w', encoding='utf-8') as f:
+            f.write(to_json(batch_counters))
+    if failed:
+        print(_("Failed: {}").format(', '.join(map(str, failed))), file=sys.stderr)
+    if abort.is_set():
+        return 130
+    return 1 if failed else 0
@@ -2,6 +2,8 @@ from qt.core import QDialog, QVBoxLayout, QLabel, QLineEdit, QPushButton, QCombo
 from calibre.utils.config import JSONConfig
 from calibre.utils.localization import _
 
+from .encoders import BACKENDS, ENCODER_PILLOW, available_encoders
+
 load_translations()  # type: ignore
 
 # プリファレンスの初期化（設定を共有するためにmain.pyと同じ）
@@ -38,8 +40,85 @@ class ConfigDialog(QDialog):
             "ICO"        # アイコン
         ])
 
+        # 品質の決め方（固定、SSIM の下限、1枚あたりのサイズ）
+        self.quality_mode_input = QComboBox(self)
+        self.quality_mode_input.addItem(_("Fixed quality"), 'fixed')
+        self.quality_mode_input.addItem(_("Lowest quality above SSIM target"), 'ssim')
+        self.quality_mode_input.addItem(_("Highest quality within size target"), 'size')
+        index = self.quality_mode_input.findData(prefs['quality_mode'])
+        if index >= 0:
+            self.quality_mode_input.setCurrentIndex(index)
+
+        self.target_ssim_input = QLineEdit(self)
+        self.target_ssim_input.setText(prefs['target_ssim'])
+        self.target_ssim_input.setPlaceholderText(_("Example: 0.95"))
+
+        self.target_kb_input = QLineEdit(self)
+        self.target_kb_input.setText(prefs['target_kb'])
+        self.target_kb_input.setPlaceholderText(_("Example: 300"))
+
+        self.grayscale_threshold_input = QLineEdit(self)
+        self.grayscale_threshold_input.setText(prefs['grayscale_threshold'])
+        self.grayscale_threshold_input.setPlaceholderText(_("0 = disabled"))
+
+        # エンコーダー（自動選択、またはインストールされているバックエンドに固定）
+        self.encoder_input = QComboBox(self)
+        self.encoder_input.addItem(_("Automatic (fastest matching output)"), 'auto')
+        installed = available_encoders()
+        for cls in BACKENDS:
+            if cls.name in installed:
+                self.encoder_input.addItem(_("Pillow (previous settings)") if cls.name == ENCODER_PILLOW else cls.name, cls.name)
+        index = self.encoder_input.findData(prefs['encoder'])
+        if index >= 0:
+            self.encoder_input.setCurrentIndex(index)
+
+        self.lossless_budget_input = QLineEdit(self)
+        self.lossless_budget_input.setText(prefs['lossless_budget'])
+        self.lossless_budget_input.setPlaceholderText(_("0 = disabled"))
+
+        self.workers_input = QLineEdit(self)
+        self.workers_input.setText(prefs['workers'])
+        self.workers_input.setPlaceholderText(_("0 = automatic"))
+
+        self.cache_size_input = QLineEdit(self)
+        self.cache_size_input.setText(prefs['cache_size'])
+        self.cache_size_input.setPlaceholderText(_("0 = disabled"))
+
+        self.books_in_flight_input = QLineEdit(self)
+        self.books_in_flight_input.setText(prefs['books_in_flight'])
+        self.books_in_flight_input.setPlaceholderText(_("Example: 2"))
+
+        self.memory_budget_input = QLineEdit(self)
+        self.memory_budget_input.setText(prefs['memory_budget'])
+        self.memory_budget_input.setPlaceholderText(_("0 = unlimited"))
+
+        self.disk_budget_input = QLineEdit(self)
+        self.disk_budget_input.setText(prefs['disk_budget'])
+        self.disk_budget_input.setPlaceholderText(_("0 = unlimited"))
+
+        self.image_memory_input = QLineEdit(self)
+        self.image_memory_input.setText(prefs['image_memory'])
+        self.image_memory_input.setPlaceholderText(_("0 = unlimited"))
+
+        self.max_megapixels_input = QLineEdit(self)
+        self.max_megapixels_input.setText(prefs['max_megapixels'])
+        self.max_megapixels_input.setPlaceholderText(_("0 = unlimited"))
+
+        self.min_savings_input = QLineEdit(self)
+        self.min_savings_input.setText(prefs['min_savings'])
+        self.min_savings_input.setPlaceholderText(_("0 = optimize every book"))
+
+        self.dry_run_input = QCheckBox(self)
+        self.dry_run_input.setChecked(prefs['dry_run'])
+
+        self.incremental_input = QCheckBox(self)
+        self.incremental_input.setChecked(prefs['incremental'])
+
         self.keep_time_import_input = QCheckBox(self)
         self.keep_time_import_input.setChecked(prefs['keep_time_import'])
+
+        self.timings_input = QCheckBox(self)
+        self.timings_input.setChecked(prefs['timings'])
         
         # 選択されたフォーマットを復元
         index = self.format_input.findText(prefs['format'])
@@ -52,8 +131,42 @@ class ConfigDialog(QDialog):
         layout.addWidget(self.quality_input)
         layout.addWidget(QLabel(_("Format Conversion:")))
         layout.addWidget(self.format_input)
+        layout.addWidget(QLabel(_("Quality Mode:")))
+        layout.addWidget(self.quality_mode_input)
+        layout.addWidget(QLabel(_("SSIM Target (0-1):")))
+        layout.addWidget(self.target_ssim_input)
+        layout.addWidget(QLabel(_("Size Target per Image (KB):")))
+        layout.addWidget(self.target_kb_input)
+        layout.addWidget(QLabel(_("Grayscale Threshold (0-255):")))
+        layout.addWidget(self.grayscale_threshold_input)
+        layout.addWidget(QLabel(_("Encoder:")))
+        layout.addWidget(self.encoder_input)
+        layout.addWidget(QLabel(_("Lossless Search Time per Image (s):")))
+        layout.addWidget(self.lossless_budget_input)
+        layout.addWidget(QLabel(_("Worker Threads:")))
+        layout.addWidget(self.workers_input)
+        layout.addWidget(QLabel(_("Cache Size (MB):")))
+        layout.addWidget(self.cache_size_input)
+        layout.addWidget(QLabel(_("Books in Parallel:")))
+        layout.addWidget(self.books_in_flight_input)
+        layout.addWidget(QLabel(_("Memory Budget (MB):")))
+        layout.addWidget(self.memory_budget_input)
+        layout.addWidget(QLabel(_("Temp Disk Budget (MB):")))
+        layout.addWidget(self.disk_budget_input)
+        layout.addWidget(QLabel(_("Memory per Image (MB):")))
+        layout.addWidget(self.image_memory_input)
+        layout.addWidget(QLabel(_("Max Image Size (megapixels):")))
+        layout.addWidget(self.max_megapixels_input)
+        layout.addWidget(QLabel(_("Skip Books Saving Less Than (%):")))
+        layout.addWidget(self.min_savings_input)
+        layout.addWidget(QLabel(_("Estimate Only (Dry Run):")))
+        layout.addWidget(self.dry_run_input)
+        layout.addWidget(QLabel(_("Reuse Previous Output:")))
+        layout.addWidget(self.incremental_input)
         layout.addWidget(QLabel(_("Keep Import Time:")))
         layout.addWidget(self.keep_time_import_input)
+        layout.addWidget(QLabel(_("Record Stage Timings:")))
+        layout.addWidget(self.timings_input)
         
         btn = QPushButton(_("Start"), self)
         btn.clicked.connect(self.save_and_accept)
@@ -64,7 +177,24 @@ class ConfigDialog(QDialog):
         prefs['size'] = self.size_input.text().strip()
         prefs['quality'] = self.quality_input.text().strip()
         prefs['format'] = self.format_input.currentText()
+        prefs['quality_mode'] = self.quality_mode_input.currentData()
+        prefs['target_ssim'] = self.target_ssim_input.text().strip()
+        prefs['target_kb'] = self.target_kb_input.text().strip()
         prefs['keep_time_import'] = self.keep_time_import_input.isChecked()
+        prefs['grayscale_threshold'] = self.grayscale_threshold_input.text().strip()
+        prefs['encoder'] = self.encoder_input.currentData()
+        prefs['lossless_budget'] = self.lossless_budget_input.text().strip()
+        prefs['workers'] = self.workers_input.text().strip()
+        prefs['cache_size'] = self.cache_size_input.text().strip()
+        prefs['books_in_flight'] = self.books_in_flight_input.text().strip()
+        prefs['memory_budget'] = self.memory_budget_input.text().strip()
+        prefs['disk_budget'] = self.disk_budget_input.text().strip()
+        prefs['image_memory'] = self.image_memory_input.text().strip()
+        prefs['max_megapixels'] = self.max_megapixels_input.text().strip()
+        prefs['min_savings'] = self.min_savings_input.text().strip()
+        prefs['dry_run'] = self.dry_run_input.isChecked()
+        prefs['incremental'] = self.incremental_input.isChecked()
+        prefs['timings'] = self.timings_input.isChecked()
         self.accept()
 
     def get_values(self):
@@ -73,5 +203,22 @@ class ConfigDialog(QDialog):
             'size': prefs['size'],
             'quality': prefs['quality'],
             'format': prefs['format'],
-            'keep_time_import': prefs['keep_time_import']
+            'quality_mode': prefs['quality_mode'],
+            'target_ssim': prefs['target_ssim'],
+            'target_kb': prefs['target_kb'],
+            'keep_time_import': prefs['keep_time_import'],
+            'grayscale_threshold': prefs['grayscale_threshold'],
+            'encoder': prefs['encoder'],
+            'lossless_budget': prefs['lossless_budget'],
+            'workers': prefs['workers'],
+            'cache_size': prefs['cache_size'],
+            'books_in_flight': prefs['books_in_flight'],
+            'memory_budget': prefs['memory_budget'],
+            'disk_budget': prefs['disk_budget'],
+            'image_memory': prefs['image_memory'],
+            'max_megapixels': prefs['max_megapixels'],
+            'min_savings': prefs['min_savings'],
+            'dry_run': prefs['dry_run'],
+            'incremental': prefs['incremental'],
+            'timings': prefs['timings']
         }
@@ -0,0 +1,376 @@
+import io, os, shutil, tempfile, threading, subprocess, time
+from PIL import Image
+
+try:
+    import pyvips
+except Exception:
+    # pyvips がない、または libvips が見つからない場合（ImportError 以外に OSError も出る）
+    pyvips = None
+
+from .quality import LOSSY_FORMATS, luma_plane, ssim
+
+# エンコーダーのバックエンド。Pillow は常に使え、外部ツール（mozjpeg の cjpeg、cwebp、oxipng）と
+# pyvips はインストールされていれば自動的に使う。
+# 各バックエンドはフォーマットごとに速い順の「労力」を持ち、キャリブレーションで
+# 従来の設定（Pillow の最も遅い労力）と同等のサイズと画質になる最も速い組み合わせを選ぶ
+
+# 自動選択（キャリブレーション）と Pillow のみの設定値。それ以外はバックエンド名で固定する
+ENCODER_AUTO = 'auto'
+ENCODER_PILLOW = 'pillow'
+
+# キャリブレーションに使う画像の数（フォーマットと品質の組み合わせごと）
+CALIBRATION_SAMPLES = 3
+# 基準（Pillow の最も遅い労力）に対して許容するサイズの増加と SSIM の低下
+SIZE_TOLERANCE = 0.02
+SSIM_TOLERANCE = 0.005
+# 外部ツールの1回の実行の上限（秒）
+TOOL_TIMEOUT = 120
+
+# Windows でコンソールウィンドウを開かない
+_CREATION_FLAGS = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+
+def normalize_format(fmt):
+    fmt = (fmt or '').upper()
+    return 'JPEG' if fmt == 'JPG' else fmt
+
+def _run_tool(args, stdin=None):
+    result = subprocess.run(args, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            timeout=TOOL_TIMEOUT, creationflags=_CREATION_FLAGS)
+    if result.returncode != 0:
+        raise RuntimeError('{} failed: {}'.format(os.path.basename(args[0]),
+                                                  result.stderr.decode('utf-8', 'replace').strip()))
+    return result.stdout
+
+def _pnm(image):
+    # cjpeg・cwebp への入力（PNM はエンコードのコストがほぼない）
+    buf = io.BytesIO()
+    image.save(buf, format='PPM')
+    return buf.getvalue()
+
+class PillowEncoder:
+    name = ENCODER_PILLOW
+    # {フォーマット: 速い順の労力}。最後が従来の設定
+    efforts = {
+        'JPEG': ('baseline', 'optimize', 'progressive'),
+        'WEBP': ('m2', 'm4', 'm6'),
+        'PNG': ('z1', 'z6', 'z9'),
+    }
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def supports(self, image, fmt):
+        return True
+
+    def efforts_for(self, fmt):
+        return self.efforts.get(fmt, ('default',))
+
+    def save_args(self, fmt, quality, effort):
+        if fmt == 'JPEG':
+            args = {'quality': quality, 'subsampling': '4:2:0', 'keep_rgb': False}
+            if effort != 'baseline':
+                args['optimize'] = True
+            if effort == 'progressive':
+                args['progressive'] = True
+            return args
+        if fmt == 'WEBP':
+            return {'quality': quality, 'method': int(effort[1:])}
+        if fmt == 'PNG':
+            # PNG は品質の代わりに圧縮レベルを使用
+            level = int(effort[1:])
+            return {'compress_level': level, 'optimize': level == 9}
+        args = {'optimize': True}
+        if fmt == 'TIFF':
+            args['compression'] = 'tiff_lzw'
+        elif fmt == 'GIF':
+            args['interlace'] = True
+        # QOI, TGA, BMP などの他のフォーマットは品質を使用しません
+        return args
+
+    def encode(self, image, fmt, quality, effort):
+        buf = io.BytesIO()
+        # "unexpected keyword argument" エラーを避けるために柔軟なパラメータを使用
+        try:
+            image.save(buf, format=fmt, **self.save_args(fmt, quality, effort))
+        except (ValueError, TypeError):
+            # 'optimize' をサポートしていない奇妙なフォーマットの場合は、純粋に保存を試みる
+            buf = io.BytesIO()
+            image.save(buf, format=fmt)
+        return buf.getvalue()
+
+class CjpegEncoder:
+    # mozjpeg の cjpeg（トレリス量子化とスキャンの最適化）。libjpeg の cjpeg でも動く
+    name = 'cjpeg'
+
+    @classmethod
+    def available(cls):
+        return shutil.which('cjpeg') is not None
+
+    def __init__(self):
+        self.path = shutil.which('cjpeg')
+        try:
+            version = subprocess.run([self.path, '-version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     timeout=TOOL_TIMEOUT, creationflags=_CREATION_FLAGS).stdout
+        except Exception:
+            version = b''
+        self.mozjpeg = b'mozjpeg' in version.lower()
+
+    def supports(self, image, fmt):
+        return fmt == 'JPEG' and image.mode in ('RGB', 'L')
+
+    def efforts_for(self, fmt):
+        if fmt != 'JPEG':
+            return ()
+        return ('fastcrush', 'default') if self.mozjpeg else ('optimize', 'progressive')
+
+    def encode(self, image, fmt, quality, effort):
+        args = [self.path, '-quality', str(quality)]
+        if image.mode == 'RGB':
+            args += ['-sample', '2x2']
+        args += {'fastcrush': ['-fastcrush'], 'default': [], 'optimize': ['-optimize'],
+                 'progressive': ['-optimize', '-progressive']}[effort]
+        return _run_tool(args, _pnm(image))
+
+class CwebpEncoder:
+    name = 'cwebp'
+
+    @classmethod
+    def available(cls):
+        return shutil.which('cwebp') is not None
+
+    def __init__(self):
+        self.path = shutil.which('cwebp')
+
+    def supports(self, image, fmt):
+        return fmt == 'WEBP' and image.mode in ('RGB', 'L', 'RGBA')
+
+    def efforts_for(self, fmt):
+        return ('m2', 'm4', 'm6') if fmt == 'WEBP' else ()
+
+    def encode(self, image, fmt, quality, effort):
+        # アルファチャンネルは PNM で渡せないので、無圧縮の PNG を入力にする
+        with tempfile.TemporaryDirectory(prefix='image_optimizer_') as tmp:
+            src = os.path.join(tmp, 'in.png' if image.mode == 'RGBA' else 'in.ppm')
+            dst = os.path.join(tmp, 'out.webp')
+            if image.mode == 'RGBA':
+                image.save(src, format='PNG', compress_level=0)
+            else:
+                with open(src, 'wb') as f:
+                    f.write(_pnm(image))
+            _run_tool([self.path, '-quiet', '-q', str(quality), '-m', effort[1:], src, '-o', dst])
+            with open(dst, 'rb') as f:
+                return f.read()
+
+class OxipngEncoder:
+    # Pillow で速く書いた PNG を oxipng で可逆に再圧縮する
+    name = 'oxipng'
+
+    @classmethod
+    def available(cls):
+        return shutil.which('oxipng') is not None
+
+    def __init__(self):
+        self.path = shutil.which('oxipng')
+
+    def supports(self, image, fmt):
+        return fmt == 'PNG'
+
+    def efforts_for(self, fmt):
+        return ('o1', 'o2', 'o4') if fmt == 'PNG' else ()
+
+    def encode(self, image, fmt, quality, effort):
+        with tempfile.TemporaryDirectory(prefix='image_optimizer_') as tmp:
+            path = os.path.join(tmp, 'image.png')
+            image.save(path, format='PNG', compress_level=1)
+            _run_tool([self.path, '-q', '-o', effort[1:], '--strip', 'safe', path])
+            with open(path, 'rb') as f:
+                return f.read()
+
+class VipsEncoder:
+    name = 'vips'
+    efforts = {
+        'JPEG': ('optimize', 'progressive'),
+        'WEBP': ('e2', 'e4', 'e6'),
+        'PNG': ('z1', 'z6', 'z9'),
+    }
+
+    @classmethod
+    def available(cls):
+        return pyvips is not None
+
+    def supports(self, image, fmt):
+        return fmt in self.efforts and image.mode in ('L', 'LA', 'RGB', 'RGBA')
+
+    def efforts_for(self, fmt):
+        return self.efforts.get(fmt, ())
+
+    def encode(self, image, fmt, quality, effort):
+        vimage = pyvips.Image.new_from_memory(image.tobytes(), image.width, image.height,
+                                              len(image.getbands()), 'uchar')
+        if fmt == 'JPEG':
+            return vimage.jpegsave_buffer(Q=quality, optimize_coding=True, interlace=effort == 'progressive',
+                                          subsample_mode='on', strip=True)
+        if fmt == 'WEBP':
+            return vimage.webpsave_buffer(Q=quality, effort=int(effort[1:]), strip=True)
+        return vimage.pngsave_buffer(compression=int(effort[1:]), strip=True)
+
+BACKENDS = (PillowEncoder, CjpegEncoder, CwebpEncoder, OxipngEncoder, VipsEncoder)
+ENCODER_CHOICES = (ENCODER_AUTO,) + tuple(cls.name for cls in BACKENDS)
+
+_lock = threading.Lock()
+_encoders = None
+
+def available_encoders():
+    # インストールされているバックエンド（最初の呼び出しで一度だけ検出する）
+    global _encoders
+    with _lock:
+        if _encoders is None:
+            _encoders = {}
+            for cls in BACKENDS:
+                try:
+                    if cls.available():
+                        _encoders[cls.name] = cls()
+                except Exception:
+                    pass
+        return _encoders
+
+def encoder_setting(params):
+    value = (params.get('encoder') or ENCODER_AUTO).strip().lower()
+    return value if value in ENCODER_CHOICES else ENCODER_AUTO
+
+def candidates(image, fmt):
+    # [(encoder, effort), ...]。先頭が基準（Pillow の最も遅い労力 = 従来の設定）
+    encoders = available_encoders()
+    pillow = encoders[ENCODER_PILLOW]
+    result = [(pillow, pillow.efforts_for(fmt)[-1])]
+    for encoder in encoders.values():
+        if encoder.supports(image, fmt):
+            result.extend((encoder, effort) for effort in encoder.efforts_for(fmt)
+                          if (encoder, effort) != result[0])
+    return result
+
+class Trial:
+    # 1つの候補のキャリブレーション結果（複数の画像の合計）
+    def __init__(self, encoder, effort):
+        self.encoder = encoder
+        self.effort = effort
+        self.seconds = 0.0
+        self.size = 0
+        self.ssim = 1.0  # 画像ごとの SSIM の最小値
+        self.failed = False
+
+    @property
+    def label(self):
+        return '{} {}'.format(self.encoder.name, self.effort)
+
+def measure(image, fmt, quality, trials):
+    # 同じ画像を全候補でエンコードし、時間・サイズ・SSIM を trials に加える
+    reference = luma_plane(image) if fmt in LOSSY_FORMATS else None
+    for trial in trials:
+        if trial.failed:
+            continue
+        try:
+            start = time.perf_counter()
+            data = trial.encoder.encode(image, fmt, quality, trial.effort)
+            trial.seconds += time.perf_counter() - start
+            trial.size += len(data)
+            if reference is not None:
+                with Image.open(io.BytesIO(data)) as decoded:
+                    trial.ssim = min(trial.ssim, ssim(reference, luma_plane(decoded, reference.size)))
+        except Exception:
+            trial.failed = True
+
+def accepted(trials):
+    # 基準と同等のサイズ・画質の候補（基準は常に含む）
+    baseline = trials[0]
+    return [t for t in trials if t is baseline or not t.failed and
+            t.size <= baseline.size * (1 + SIZE_TOLERANCE) and t.ssim >= baseline.ssim - SSIM_TOLERANCE]
+
+def fastest(trials):
+    return min(accepted(trials), key=lambda t: t.seconds)
+
+class Calibration:
+    # フォーマットと品質の組み合わせごとに、最初の数枚の画像で全候補を試して選ぶ
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}  # key -> [trials, 予約済みの画像数, 計測済みの画像数, 選択]
+
+    def select(self, image, fmt, quality, counters=None):
+        # (encoder, effort) を返す。計測中は基準を使う
+        options = candidates(image, fmt)
+        if len(options) == 1:
+            return options[0]
+        key = (fmt, quality, tuple((e.name, effort) for e, effort in options))
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                state = self._state[key] = [[Trial(e, effort) for e, effort in options], 0, 0, None]
+            if state[3] is not None:
+                return state[3]
+            if state[1] >= CALIBRATION_SAMPLES:
+                return options[0]
+            state[1] += 1
+            # 他のスレッドの計測と混ざらないよう、この画像の結果は別に集めてから合計する
+            trials = [Trial(t.encoder, t.effort) for t in state[0]]
+
+        # Image.save は encoderinfo を画像に書き込むので、計測にはコピーを使う
+        measure(image.copy(), fmt, quality, trials)
+        if counters is not None: counters['calibration_encodes'] += len(trials)
+
+        with self._lock:
+            for total, trial in zip(state[0], trials):
+                total.seconds += trial.seconds
+                total.size += trial.size
+                total.ssim = min(total.ssim, trial.ssim)
+                total.failed = total.failed or trial.failed
+            state[2] += 1
+            best = fastest(state[0])
+            if state[2] >= CALIBRATION_SAMPLES:
+                state[3] = (best.encoder, best.effort)
+            return best.encoder, best.effort
+
+    def results(self):
+        # {(フォーマット, 品質): [Trial, ...]}（ベンチマーク用）
+        with self._lock:
+            return {key[:2]: list(state[0]) for key, state in self._state.items()}
+
+calibration = Calibration()
+
+def select_encoder(image, fmt, quality, params, counters=None):
+    # 設定に応じたエンコーダーと労力。固定したバックエンドが使えない画像は Pillow で書く
+    setting = encoder_setting(params)
+    if setting == ENCODER_AUTO:
+        return calibration.select(image, fmt, quality, counters)
+    encoders = available_encoders()
+    encoder = encoders.get(setting)
+    if encoder is None or not encoder.supports(image, fmt) or not encoder.efforts_for(fmt):
+        encoder = encoders[ENCODER_PILLOW]
+    return encoder, encoder.efforts_for(fmt)[-1]
+
+def record(counters, encoder, effort):
+    if counters is not None: counters['encoder:{}:{}'.format(encoder.name, effort)] += 1
+
+def encode_with(encoder, effort, image, fmt, quality, counters=None):
+    # 外部ツールが失敗した場合（壊れたインストールなど）は Pillow の従来の設定で書き直す。
+    # counters を指定すると、実際に使ったエンコーダーを記録する
+    try:
+        data = encoder.encode(image, fmt, quality, effort)
+    except Exception:
+        if encoder.name == ENCODER_PILLOW:
+            raise
+        if counters is not None: counters['encoder_errors'] += 1
+        encoder = available_encoders()[ENCODER_PILLOW]
+        effort = encoder.efforts_for(fmt)[-1]
+        data = encoder.encode(image, fmt, quality, effort)
+    record(counters, encoder, effort)
+    return data
+
+def encoder_lines(counters):
+    # "encoder:<名前>:<労力>" の集計を「名前 労力: 枚数」の行にする
+    lines = []
+    for key, value in sorted(counters.items()):
+        if key.startswith('encoder:') and value:
+            _kind, name, effort = key.split(':', 2)
+            lines.append('{} {}: {}'.format(name, effort, value))
+    return lines
@@ -0,0 +1,199 @@
+import os, math, time, random, zipfile
+from collections import Counter
+
+from calibre.utils.localization import _
+
+from .optimizer import optimize_image_logic
+from .pool import map_ordered, resolve_workers
+from .zipstream import sniff_entry
+from .classify import EntryClassifier
+from .manifest import MANIFEST_NAME
+from .adapters import find_adapter
+
+load_translations()  # type: ignore
+
+# 試し実行: 各ブックから画像エントリを少しだけ抜き出して最適化し、削減量と処理時間を外挿する。
+# ライブラリには何も書き込まない（結果はキャッシュに入るので、本番の実行でそのまま使われる）
+
+# 1冊あたりの標本数（まず全ブックから1枚ずつ、時間が残れば2枚目以降を処理する）
+SAMPLES_PER_BOOK = 3
+# 標本の処理にかける時間の上限（秒）。標本のないブックは全体の平均で外挿する
+TIME_LIMIT = 45.0
+# 信頼区間の係数（95%）
+Z_95 = 1.96
+
+class BookEstimate:
+    def __init__(self, book_id, title):
+        self.book_id = book_id
+        self.title = title
+        self.total_bytes = 0  # 全フォーマットのファイルサイズ
+        self.images = []  # (fmt, path, エントリ名, 圧縮後のサイズ)
+        self.sampled_in = 0
+        self.sampled_out = 0
+        self.sampled_seconds = 0.0
+        self.samples = 0
+        # 標本を取れないフォーマット（PDF・MOBI など）を含む場合は、削減率のしきい値で除かない
+        self.unscanned = False
+        # extrapolate() で設定する
+        self.saved_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def image_bytes(self):
+        return sum(size for _fmt, _path, _name, size in self.images)
+
+    @property
+    def savings_percent(self):
+        return self.saved_bytes * 100.0 / self.total_bytes if self.total_bytes else 0.0
+
+def scan_book(db, book_id, formats_data):
+    # 中央ディレクトリと OPF だけを読み、画像エントリを列挙する
+    estimate = BookEstimate(book_id, db.field_for('title', book_id))
+    for fmt, path in formats_data.items():
+        if not path or not os.path.exists(path):
+            continue
+        estimate.total_bytes += os.path.getsize(path)
+        if not zipfile.is_zipfile(path):
+            estimate.unscanned = estimate.unscanned or find_adapter(fmt, path) is not None
+            continue
+        with zipfile.ZipFile(path, 'r') as yin:
+            classifier = EntryClassifier(yin)
+            for item in yin.infolist():
+                if item.filename in ('mimetype', 'calibre_bookmarks.txt', MANIFEST_NAME) or item.is_dir():
+                    continue
+                kind = classifier.classify(item)
+                if kind is None:
+                    from .processing import get_image_type
+                    kind = get_image_type(sniff_entry(yin, item)) is not None
+                if kind:
+                    estimate.images.append((fmt, path, item.filename, item.compress_size))
+    return estimate
+
+def sample_entry(estimate, fmt, path, name, params):
+    from .processing import get_image_type
+    with zipfile.ZipFile(path, 'r') as yin:
+        data = yin.read(name)
+    if not get_image_type(data[:32]):
+        return estimate, len(data), len(data), 0.0
+    counters = Counter()
+    start = time.perf_counter()
+    output = optimize_image_logic(data, params, counters)
+    seconds = time.perf_counter() - start
+    # キャッシュに当たった場合は、元のエンコードにかかった時間を使う
+    if counters['cache_hits']:
+        seconds = counters['cache_saved_seconds']
+    return estimate, len(data), len(output), seconds
+
+def extrapolate(estimates, workers=1):
+    # 標本の比率（出力 / 入力）と処理速度（秒 / バイト）をブックの画像全体に当てはめる
+    sampled_in = sum(e.sampled_in for e in estimates)
+    sampled_out = sum(e.sampled_out for e in estimates)
+    sampled_seconds = sum(e.sampled_seconds for e in estimates)
+    ratio = sampled_out / sampled_in if sampled_in else 1.0
+    speed = sampled_seconds / sampled_in if sampled_in else 0.0
+    for e in estimates:
+        book_ratio = e.sampled_out / e.sampled_in if e.sampled_in else ratio
+        book_speed = e.sampled_seconds / e.sampled_in if e.sampled_in else speed
+        image_bytes = e.image_bytes
+        e.saved_bytes = int(image_bytes * (1 - min(1.0, book_ratio)))
+        e.seconds = image_bytes * book_speed
+
+    total_image_bytes = sum(e.image_bytes for e in estimates)
+    return {
+        'books': len(estimates),
+        'samples': sum(e.samples for e in estimates),
+        'total_bytes': sum(e.total_bytes for e in estimates),
+        'saved_bytes': sum(e.saved_bytes for e in estimates),
+        'saved_margin': int(total_image_bytes * Z_95 * _ratio_error(estimates, ratio)),
+        'seconds': sum(e.seconds for e in estimates),
+        'eta': sum(e.seconds for e in estimates) / max(1, workers),
+    }
+
+def _ratio_error(estimates, ratio):
+    # 比推定量の標準誤差（ブックを単位とした標本の重み付き分散から求める）
+    sampled = [e for e in estimates if e.sampled_in]
+    if len(sampled) < 2:
+        return 0.0
+    total = sum(e.sampled_in for e in sampled)
+    variance = sum((e.sampled_out - ratio * e.sampled_in) ** 2 for e in sampled) / (len(sampled) - 1)
+    return math.sqrt(variance * len(sampled)) / total
+
+def estimate_books(book_ids, params, db, abort=None, log=None, notifications=None, time_limit=TIME_LIMIT):
+    # [(BookEstimate), ...] と合計を返す
+    from .processing import book_formats
+    estimates = []
+    for index, book_id in enumerate(book_ids):
+        if abort is not None and abort.is_set():
+            break
+        try:
+            estimates.append(scan_book(db, book_id, book_formats(db, book_id)))
+        except Exception as e:
+            if log: log.error(_("Error {}: {}").format(book_id, str(e)))
+        if notifications:
+            notifications.put((0.2 * (index + 1) / len(book_ids), _("Scanning books...")))
+
+    # ブックごとに再現可能な標本を選び、まず全ブックの1枚目、次に2枚目…の順に処理する
+    rounds = []
+    for e in estimates:
+        picks = random.Random(e.book_id).sample(e.images, min(SAMPLES_PER_BOOK, len(e.images)))
+        for i, pick in enumerate(picks):
+            while len(rounds) <= i:
+                rounds.append([])
+            rounds[i].append((e, pick))
+    for r in rounds:
+        random.Random(len(r)).shuffle(r)
+    tasks = [task for r in rounds for task in r]
+
+    deadline = time.monotonic() + time_limit
+
+    def sample_tasks():
+        for e, (fmt, path, name, _size) in tasks:
+            if time.monotonic() > deadline:
+                break
+            yield e, fmt, path, name, params
+
+    done = 0
+    for e, size_in, size_out, seconds in map_ordered(sample_entry, sample_tasks(), params.get('workers'), abort):
+        e.sampled_in += size_in
+        e.sampled_out += min(size_in, size_out)
+        e.sampled_seconds += seconds
+        e.samples += 1
+        done += 1
+        if notifications:
+            notifications.put((0.2 + 0.8 * done / max(1, len(tasks)), _("Sampling images...")))
+
+    totals = extrapolate(estimates, resolve_workers(params.get('workers')))
+    return estimates, totals
+
+def estimate_summary(totals):
+    return _("{} books, {} images sampled: {:.1f}MB of {:.1f}MB saved (±{:.1f}MB), about {:.0f}s of encoding, ETA {:.0f}s").format(
+        totals['books'], totals['samples'], totals['saved_bytes'] / 1048576, totals['total_bytes'] / 1048576,
+        totals['saved_margin'] / 1048576, totals['seconds'], totals['eta'])
+
+def estimate_lines(estimates):
+    return [_("• {}: {:.1f}% ({:.1f}MB), {:.1f}s").format(
+        e.title, e.savings_percent, e.saved_bytes / 1048576, e.seconds) for e in estimates]
+
+def parse_percent(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0.0
+
+def filter_books(book_ids, params, db, abort=None, log=None, notifications=None, on_skipped=None):
+    # 推定削減率が min_savings (%) 未満のブックを除く。on_skipped(book_ids) には見積もった結果除いたブックを渡す
+    # （キャンセルで見積もらなかったブックは含めない）
+    threshold = parse_percent(params.get('min_savings'))
+    if not threshold or not book_ids:
+        return list(book_ids)
+    estimates, totals = estimate_books(book_ids, params, db, abort, log, notifications)
+    if log:
+        log(estimate_summary(totals))
+    keep = {e.book_id for e in estimates if e.unscanned or e.savings_percent >= threshold}
+    skipped = [book_id for book_id in book_ids if book_id not in keep]
+    if log and skipped:
+        log(_("{} books skipped (projected savings below {:.1f}%)").format(len(skipped), threshold))
+    below = [e.book_id for e in estimates if e.book_id not in keep]
+    if on_skipped is not None and below:
+        on_skipped(below)
+    return [book_id for book_id in book_ids if book_id in keep]
@@ -0,0 +1,72 @@
+import io
+from PIL import Image, ImageChops
+
+# 見た目がグレースケールの RGB 画像（漫画・コミックのページに多い）を 'L' に変換し、
+# 白黒2値に近い線画は少ない色数のパレットにする。判定は C で実装された Pillow のチャンネル演算で行う
+
+# 判定に使う間引き画像の長辺（px）
+SAMPLE_SIDE = 256
+# チャンネル差が閾値を超える画素がこの割合以下ならグレースケールとみなす（JPEG の色にじみを無視する）
+COLOR_FRACTION = 0.001
+# 黒（0..BILEVEL_MARGIN）と白（255-BILEVEL_MARGIN..255）以外の画素がこの割合以下なら2値とみなす
+BILEVEL_MARGIN = 48
+BILEVEL_FRACTION = 0.05
+# 2値の画像に使う色数（アンチエイリアスを残すため2色より少し多くする）
+PALETTE_COLORS = 4
+# パレットで保存できる出力フォーマット
+PALETTE_FORMATS = ('PNG', 'GIF')
+
+DEFAULT_THRESHOLD = 8
+
+def parse_threshold(params):
+    # R・G・B の差の許容値（0 = 無効）
+    try:
+        return max(0, min(255, int(params.get('grayscale_threshold', DEFAULT_THRESHOLD))))
+    except (TypeError, ValueError):
+        return DEFAULT_THRESHOLD
+
+def _sample(image):
+    # 最近傍で間引く（平均すると色の付いた細い線が消えてしまう）
+    w, h = image.size
+    step = max(w, h) // SAMPLE_SIDE
+    if step <= 1:
+        return image
+    return image.resize((max(1, w // step), max(1, h // step)), Image.Resampling.NEAREST)
+
+def is_grayscale(image, threshold):
+    r, g, b = _sample(image).convert('RGB').split()
+    diff = ImageChops.lighter(ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b)),
+                              ImageChops.difference(r, b))
+    hist = diff.histogram()
+    return sum(hist[threshold + 1:]) <= COLOR_FRACTION * sum(hist)
+
+def is_bilevel(gray):
+    hist = _sample(gray).histogram()
+    return sum(hist[BILEVEL_MARGIN + 1:255 - BILEVEL_MARGIN]) <= BILEVEL_FRACTION * sum(hist)
+
+def probe_grayscale(img_data, threshold):
+    # デコード前の判定用。JPEG は 1/8 の解像度でデコードするので、フルデコードよりずっと速い
+    if not threshold:
+        return False
+    try:
+        with Image.open(io.BytesIO(img_data)) as image:
+            if image.mode != 'RGB':
+                return False
+            image.draft('RGB', (image.width // 8, image.height // 8))
+            return is_grayscale(image, threshold)
+    except Exception:
+        return False
+
+def reduce_mode(image, target_format, threshold, counters=None):
+    # エンコードする直前の画像を受け取り、必要なら色数を減らした画像を返す
+    if not threshold or image.mode not in ('RGB', 'L'):
+        return image
+    if image.mode == 'RGB':
+        if not is_grayscale(image, threshold):
+            return image
+        image = image.convert('L')
+        if counters is not None: counters['grayscale'] += 1
+    if target_format.upper() in PALETTE_FORMATS and is_bilevel(image):
+        image = image.quantize(PALETTE_COLORS)
+        if counters is not None: counters['bilevel'] += 1
+    return image
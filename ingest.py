@@ -0,0 +1,158 @@
+import os, errno, queue, shutil, tempfile, threading
+from datetime import datetime, timezone
+
+from calibre.utils.localization import _
+
+load_translations()  # type: ignore
+
+# 最適化したブックのライブラリへの取り込み。
+# 出力はライブラリと同じファイルシステムに書き、calibre が使うファイル名に移動してから登録する
+# （add_format は同じファイルならコピーしない）。取り込みは GUI スレッドではなく専用のスレッドで行い、
+# 完了したブックをまとめて追加して、バッチごとに1回だけ通知する
+
+# ライブラリ内に作る一時ディレクトリの接頭辞（バッチの終了時に削除する）
+STAGING_PREFIX = '.image_optimizer_'
+# 1回の取り込みでまとめて追加する最大のブック数
+INGEST_BATCH = 16
+# 空き容量の確認で残しておく余裕（バイト）
+FREE_SPACE_MARGIN = 256 * 1024 * 1024
+
+def create_staging_dir(library_path):
+    # ライブラリに書き込めない場合は None（システムの一時ディレクトリを使う）
+    try:
+        return tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=library_path)
+    except OSError:
+        return None
+
+def remove_staging_dir(path):
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+
+def preflight(db, book_ids, staging_dir=None):
+    # 出力は入力より大きくならない前提で、選択したブックの合計サイズ分の空きがあるか確認する
+    needed = 0
+    for book_id in book_ids:
+        for fmt in db.formats(book_id) or ():
+            path = db.format_abspath(book_id, fmt)
+            try:
+                needed += os.path.getsize(path)
+            except (TypeError, OSError):
+                pass
+    for path in {db.backend.library_path, staging_dir or tempfile.gettempdir()}:
+        free = shutil.disk_usage(path).free
+        if needed + FREE_SPACE_MARGIN > free:
+            raise OSError(errno.ENOSPC, _("Not enough free space in {}: {:.0f}MB needed, {:.0f}MB free").format(
+                path, (needed + FREE_SPACE_MARGIN) / 1048576, free / 1048576))
+    return needed
+
+def _library_path(db, book_id, fmt):
+    # calibre の Cache.add_format と同じ方法で、追加後のファイルのパスを求める
+    title = db.field_for('title', book_id, default_value=_('Unknown'))
+    try:
+        author = db.field_for('authors', book_id, default_value=(_('Unknown'),))[0]
+    except IndexError:
+        author = _('Unknown')
+    ext = '.' + fmt.lower()
+    fname = db.backend.construct_file_name(book_id, title, author, len(ext))
+    return os.path.join(db.backend.library_path, db.field_for('path', book_id).replace('/', os.sep), fname + ext)
+
+def add_staged_format(db, book_id, fmt, staged):
+    dest = None
+    try:
+        dest = _library_path(db, book_id, fmt)
+        if os.path.exists(dest):
+            dest = None
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(staged, dest)
+    except Exception:
+        dest = None
+
+    if dest is None:
+        # 移動できない場合（別のファイルシステムなど）はコピーする
+        try:
+            db.add_format(book_id, fmt, staged, run_hooks=False)
+        finally:
+            if os.path.exists(staged): os.remove(staged)
+        return
+
+    try:
+        with open(dest, 'rb') as f:
+            db.add_format(book_id, fmt, f, run_hooks=False)
+    finally:
+        # calibre が別の名前でコピーした場合や失敗した場合は、移動したファイルを残さない
+        registered = db.format_abspath(book_id, fmt)
+        if not registered or os.path.normcase(os.path.abspath(registered)) != os.path.normcase(os.path.abspath(dest)):
+            if os.path.exists(dest): os.remove(dest)
+
+class Ingestor:
+    def __init__(self, db, on_batch, log=None):
+        # on_batch([(book_id, new_id, result, error), ...]) は取り込みスレッドから呼ばれる
+        self.db = db
+        self.on_batch = on_batch
+        self.log = log
+        self.failed = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='image_optimizer_ingest', daemon=True)
+        self._thread.start()
+
+    def submit(self, book_id, result):
+        self._queue.put((book_id, result))
+
+    def close(self):
+        # 残りをすべて取り込んでからスレッドを終了する
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch, closing = [], False
+            item = self._queue.get()
+            while True:
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+                if len(batch) >= INGEST_BATCH:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._commit(batch)
+            if closing:
+                return
+
+    def _commit(self, batch):
+        # on_batch には (book_id, new_id, result, error) を渡す。error は失敗した場合のメッセージ（成功なら None）
+        added = []
+        for book_id, result in batch:
+            mi, optimized_formats, stats, keep_time_import, counters = result
+            new_id, error = None, None
+            try:
+                if optimized_formats:
+                    if not keep_time_import:
+                        mi.timestamp = datetime.now(timezone.utc)
+                    new_id = self.db.create_book_entry(mi, add_duplicates=True)
+                    for fmt, temp_path in optimized_formats.items():
+                        add_staged_format(self.db, new_id, fmt, temp_path)
+            except Exception as e:
+                error = str(e)
+                self.failed.append(book_id)
+                if self.log: self.log.error(_("Error {}: {}").format(book_id, error))
+                # フォーマットが揃っていないブックは残さない（次回やり直せるようにする）
+                if new_id is not None:
+                    try: self.db.remove_books((new_id,))
+                    except Exception: pass
+                    new_id = None
+            finally:
+                for temp_path in optimized_formats.values():
+                    if os.path.exists(temp_path):
+                        try: os.remove(temp_path)
+                        except OSError: pass
+            added.append((book_id, new_id, result, error))
+        try:
+            self.on_batch(added)
+        except Exception as e:
+            if self.log: self.log.error(_("Error {}: {}").format(', '.join(str(item[0]) for item in added), str(e)))
@@ -0,0 +1,377 @@
+import io, math, time, zlib, struct
+from functools import partial
+from PIL import Image, ImageChops, ImageSequence
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy がない場合は統計を Pillow で求め、PNG の書き込みも Pillow に任せる（フィルターは選べない）
+    np = None
+
+# PNG・GIF の可逆圧縮エンジン。画像の統計（色数、アルファの使い方、グレースケールか、エントロピー）から
+# パレット化・ビット深度の削減（いずれも可逆）と、PNG のフィルターと zlib の戦略の候補を決め、
+# 1枚あたりの CPU 時間の予算内で候補を順に試して最も小さい出力を使う。
+# アニメーション（GIF・APNG）はすべてのフレームを残す
+
+LOSSLESS_FORMATS = ('PNG', 'GIF')
+ANIMATION_FORMATS = ('PNG', 'GIF', 'WEBP')
+
+# 1枚あたりの CPU 時間の予算（秒）。最初の候補は予算に関係なく必ず試す
+DEFAULT_BUDGET = 1.0
+# バイトのエントロピー（ビット）がこれ未満の画像は、図やスクリーンショットのような平坦な画像として扱う
+FLAT_ENTROPY = 4.0
+# 色数を数える前に間引いた画像で確認する画素数
+SAMPLE_PIXELS = 1 << 20
+# フィルターを計算する行数の単位（中間バッファを抑える）
+FILTER_ROWS = 256
+
+# PNG のフィルターの種類と、行ごとに最も小さくなるものを選ぶ adaptive
+FILTERS = ('none', 'sub', 'up', 'avg', 'paeth')
+ADAPTIVE = 'adaptive'
+# zlib の戦略
+STRATEGIES = {'default': zlib.Z_DEFAULT_STRATEGY, 'filtered': zlib.Z_FILTERED, 'rle': zlib.Z_RLE}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# ICC プロファイルのヘッダーの色空間（オフセット 16）と、それを付けられる出力のモード（パレットは RGB）
+ICC_COLOR_SPACE_OFFSET = 16
+ICC_COLOR_SPACES = {'L': b'GRAY', 'LA': b'GRAY', 'RGB': b'RGB ', 'RGBA': b'RGB ', 'P': b'RGB '}
+# PNG のカラータイプ
+COLOR_TYPES = {'L': 0, 'RGB': 2, 'P': 3, 'LA': 4, 'RGBA': 6}
+
+def parse_budget(params):
+    try:
+        return max(0.0, float(params.get('lossless_budget')))
+    except (TypeError, ValueError):
+        return DEFAULT_BUDGET
+
+class Stats:
+    def __init__(self, colors, alpha, gray, entropy):
+        self.colors = colors  # 256 色以下なら色数、それより多ければ None
+        self.alpha = alpha  # 'none'（すべて不透明）、'binary'（0 と 255 のみ）、'full'
+        self.gray = gray
+        self.entropy = entropy  # 1 バイトあたりのエントロピー（ビット）
+
+    @property
+    def flat(self):
+        return self.colors is not None or self.entropy < FLAT_ENTROPY
+
+def normalize(image):
+    # 統計と書き込みに使うモード（L、LA、RGB、RGBA）にする。16 ビットなど可逆に扱えないモードは None
+    if image.mode == 'P':
+        transparent = 'transparency' in image.info or image.palette is not None and image.palette.mode == 'RGBA'
+        return image.convert('RGBA' if transparent else 'RGB')
+    if image.mode == '1':
+        return image.convert('L')
+    if image.mode in ('L', 'RGB') and 'transparency' in image.info:
+        return image.convert('LA' if image.mode == 'L' else 'RGBA')
+    if image.mode in ('L', 'LA', 'RGB', 'RGBA'):
+        return image
+    return None
+
+def _entropy(histogram):
+    total = float(sum(histogram))
+    if not total:
+        return 0.0
+    result = 0.0
+    for count in histogram:
+        if count:
+            p = count / total
+            result -= p * math.log2(p)
+    return result
+
+def image_stats(image):
+    # image は normalize() 済みであること
+    if np is not None:
+        return _numpy_stats(np.asarray(image))
+    return _pillow_stats(image)
+
+def _numpy_stats(arr):
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    h, w, channels = arr.shape
+    alpha = 'none'
+    if channels in (2, 4):
+        a = arr[:, :, -1]
+        if a.min() < 255:
+            alpha = 'binary' if not np.any((a > 0) & (a < 255)) else 'full'
+    gray = channels < 3 or bool(np.array_equal(arr[:, :, 0], arr[:, :, 1]) and np.array_equal(arr[:, :, 1], arr[:, :, 2]))
+
+    def count_colors(pixels):
+        packed = np.zeros(pixels.shape[:2], dtype=np.uint32)
+        for c in range(channels):
+            packed = (packed << 8) | pixels[:, :, c]
+        return len(np.unique(packed))
+
+    colors = None
+    # 大きな画像は間引いた画素で 256 色を超えることが分かれば、全体を数えない
+    step = max(1, int((h * w / SAMPLE_PIXELS) ** 0.5))
+    if step == 1 or count_colors(arr[::step, ::step]) <= 256:
+        count = count_colors(arr)
+        colors = count if count <= 256 else None
+    entropy = _entropy(np.bincount(arr.ravel(), minlength=256).tolist())
+    return Stats(colors, alpha, gray, entropy)
+
+def _pillow_stats(image):
+    bands = image.split()
+    alpha = 'none'
+    if image.mode in ('LA', 'RGBA'):
+        hist = bands[-1].histogram()
+        if sum(hist[:255]):
+            alpha = 'binary' if not sum(hist[1:255]) else 'full'
+    gray = image.mode in ('L', 'LA') or (
+        ImageChops.difference(bands[0], bands[1]).getbbox() is None and
+        ImageChops.difference(bands[1], bands[2]).getbbox() is None)
+    colors = image.getcolors(256)
+    hist = [sum(values) for values in zip(*(band.histogram() for band in bands))]
+    return Stats(len(colors) if colors else None, alpha, gray, _entropy(hist))
+
+def reduce_image(image, stats):
+    # 可逆な削減: 不透明なアルファを除き、R=G=B ならグレースケールにする
+    if stats.alpha == 'none' and image.mode in ('LA', 'RGBA'):
+        image = image.convert(image.mode[:-1])
+    if stats.gray and image.mode in ('RGB', 'RGBA'):
+        image = image.convert('L' if image.mode == 'RGB' else 'LA')
+    return image
+
+def _bit_depth(colors):
+    for bits in (1, 2, 4):
+        if colors <= 1 << bits:
+            return bits
+    return 8
+
+class Plan:
+    # PNG に書くデータ: カラータイプ、ビット深度、行のバイト列（NumPy 配列）と PLTE/tRNS
+    def __init__(self, mode, bits, rows, bpp, palette=None, trns=None, label=''):
+        self.mode = mode
+        self.bits = bits
+        self.rows = rows
+        self.bpp = bpp  # フィルターで左隣とみなすバイト数
+        self.palette = palette
+        self.trns = trns
+        self.label = label
+
+def _pack(indices, bits):
+    # 1 バイトに 8 / bits 個のインデックスを詰める（行末は 0 で埋める）
+    if bits == 8:
+        return indices
+    per_byte = 8 // bits
+    h, w = indices.shape
+    padded = np.zeros((h, -(-w // per_byte) * per_byte), dtype=np.uint8)
+    padded[:, :w] = indices
+    groups = padded.reshape(h, -1, per_byte)
+    packed = np.zeros(groups.shape[:2], dtype=np.uint8)
+    for k in range(per_byte):
+        packed |= groups[:, :, k] << (8 - bits * (k + 1))
+    return packed
+
+def plans(image, stats):
+    # 書き込みの候補（パレット・ビット深度の違い）。可逆なものだけを返す
+    arr = np.asarray(image)
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    h, w, channels = arr.shape
+    result = []
+    # グレースケールの写真は 8 ビットの L のほうが小さい（パレットは 16 色以下のときだけ使う）
+    if stats.colors is not None and (channels > 1 or stats.colors <= 16):
+        packed = np.zeros((h, w), dtype=np.uint32)
+        for c in range(channels):
+            packed = (packed << 8) | arr[:, :, c]
+        values, indices = np.unique(packed, return_inverse=True)
+        entries = np.stack([(values >> (8 * (channels - 1 - c))) & 0xFF for c in range(channels)], axis=1).astype(np.uint8)
+        if image.mode in ('LA', 'RGBA'):
+            # tRNS を短くするため、透明を含む色を先にする
+            order = np.argsort(entries[:, -1] == 255, kind='stable')
+            remap = np.empty_like(order)
+            remap[order] = np.arange(len(order))
+            entries, indices = entries[order], remap[indices]
+        colors = entries[:, :-1] if image.mode in ('LA', 'RGBA') else entries
+        rgb = np.repeat(colors, 3, axis=1) if colors.shape[1] == 1 else colors
+        trns = None
+        if image.mode in ('LA', 'RGBA'):
+            alpha = entries[:, -1]
+            opaque = np.nonzero(alpha < 255)[0]
+            trns = alpha[:opaque[-1] + 1].tobytes() if len(opaque) else None
+        bits = _bit_depth(len(values))
+        rows = _pack(indices.reshape(h, w).astype(np.uint8), bits)
+        result.append(Plan('P', bits, rows, 1, rgb.tobytes(), trns, 'p{}'.format(bits)))
+    if stats.colors is None or channels == 1 or stats.colors > 16:
+        result.append(Plan(image.mode, 8, arr.reshape(h, w * channels), channels, label=image.mode.lower()))
+    return result
+
+def _filtered(x, prev, bpp, kind):
+    # x・prev は int16 の行の配列（prev は直前の行、先頭は 0）。戻り値はフィルター後の uint8
+    left = np.zeros_like(x)
+    left[:, bpp:] = x[:, :-bpp]
+    up = prev
+    if kind == 'none':
+        out = x
+    elif kind == 'sub':
+        out = x - left
+    elif kind == 'up':
+        out = x - up
+    elif kind == 'avg':
+        out = x - ((left + up) >> 1)
+    else:
+        upleft = np.zeros_like(x)
+        upleft[:, bpp:] = up[:, :-bpp]
+        p = left + up - upleft
+        pa, pb, pc = np.abs(p - left), np.abs(p - up), np.abs(p - upleft)
+        out = x - np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+    return (out & 0xFF).astype(np.uint8)
+
+def _filter_chunks(plan, filter_kind):
+    # FILTER_ROWS 行ずつ、先頭にフィルターの種類を付けた行のバイト列を返す
+    rows = plan.rows
+    h, row_bytes = rows.shape
+    last = np.zeros((1, row_bytes), dtype=np.int16)
+    for top in range(0, h, FILTER_ROWS):
+        x = rows[top:top + FILTER_ROWS].astype(np.int16)
+        prev = np.concatenate([last, x[:-1]])
+        if filter_kind == ADAPTIVE:
+            # 行ごとに、符号付きの値の絶対値の合計が最小になるフィルターを選ぶ（libpng と同じ方法）
+            candidates = np.stack([_filtered(x, prev, plan.bpp, kind) for kind in FILTERS])
+            signed = candidates.astype(np.int16)
+            cost = np.minimum(signed, 256 - signed).sum(axis=2)
+            types = cost.argmin(axis=0).astype(np.uint8)
+            data = candidates[types, np.arange(len(types))]
+        else:
+            types = np.full(len(x), FILTERS.index(filter_kind), dtype=np.uint8)
+            data = _filtered(x, prev, plan.bpp, filter_kind)
+        out = np.empty((len(x), row_bytes + 1), dtype=np.uint8)
+        out[:, 0] = types
+        out[:, 1:] = data
+        last = x[-1:]
+        yield out.tobytes()
+
+def icc_profile(profile, mode):
+    # 出力のモードの色空間と一致する場合だけプロファイルを返す
+    # （グレースケールやパレットに減らした画像に RGB のプロファイルは付けられない）
+    if not profile or len(profile) < ICC_COLOR_SPACE_OFFSET + 4:
+        return None
+    space = profile[ICC_COLOR_SPACE_OFFSET:ICC_COLOR_SPACE_OFFSET + 4]
+    return profile if ICC_COLOR_SPACES.get(mode) == space else None
+
+def _chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+def write_png(plan, size, filter_kind, strategy, info=None):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, STRATEGIES[strategy])
+    idat = b''.join(compressor.compress(chunk) for chunk in _filter_chunks(plan, filter_kind)) + compressor.flush()
+    w, h = size
+    parts = [PNG_SIGNATURE, _chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, plan.bits, COLOR_TYPES[plan.mode], 0, 0, 0))]
+    icc = icc_profile((info or {}).get('icc_profile'), plan.mode)
+    if icc:
+        parts.append(_chunk(b'iCCP', b'ICC Profile\x00\x00' + zlib.compress(icc)))
+    if plan.palette is not None:
+        parts.append(_chunk(b'PLTE', plan.palette))
+    if plan.trns:
+        parts.append(_chunk(b'tRNS', plan.trns))
+    parts.append(_chunk(b'IDAT', idat))
+    parts.append(_chunk(b'IEND', b''))
+    return b''.join(parts)
+
+def png_candidates(plan, stats):
+    # 内容に応じて、最も小さくなりそうな順に (フィルター, 戦略) を並べる
+    if plan.mode == 'P' and plan.bits < 8:
+        return [('none', 'default'), ('none', 'rle'), (ADAPTIVE, 'default'), ('sub', 'default'), ('up', 'default')]
+    if plan.mode == 'P' or stats.flat:
+        return [(ADAPTIVE, 'default'), ('none', 'default'), ('up', 'rle'), ('sub', 'default'), ('paeth', 'default')]
+    return [(ADAPTIVE, 'default'), (ADAPTIVE, 'filtered'), ('paeth', 'default'), ('up', 'default'), ('avg', 'filtered')]
+
+def _pillow_png(image, strategy):
+    buf = io.BytesIO()
+    image.save(buf, format='PNG', optimize=strategy == 'default', compress_level=9, compress_type=STRATEGIES[strategy],
+               icc_profile=icc_profile(image.info.get('icc_profile'), image.mode))
+    return buf.getvalue()
+
+def _pillow_candidates(image, stats):
+    # NumPy がない場合: 色数が少なければ Pillow のパレットに変換し（元に戻せることを確認する）、zlib の戦略だけを選ぶ
+    images = []
+    if stats.colors is not None and (image.mode == 'RGB' or image.mode == 'L' and stats.colors <= 16):
+        palette = image.convert('P', palette=Image.Palette.ADAPTIVE, colors=stats.colors)
+        if ImageChops.difference(palette.convert(image.mode), image).getbbox() is None:
+            images.append((palette, 'p'))
+    images.append((image, image.mode.lower()))
+    strategies = ('default', 'rle', 'filtered') if stats.flat else ('default', 'filtered', 'rle')
+    return [(candidate, strategy, label) for candidate, label in images for strategy in strategies]
+
+class LosslessEngine:
+    name = 'lossless'
+
+    def encode(self, image, fmt, budget, counters=None):
+        # (bytes, ラベル) を返す。対応しないモードの画像は None
+        if fmt == 'GIF':
+            return self.encode_gif(image, budget)
+        base = normalize(image)
+        if base is None:
+            return None
+        stats = image_stats(base)
+        base = reduce_image(base, stats)
+        if counters is not None:
+            if stats.colors is not None: counters['lossless_palette'] += 1
+            if stats.gray and image.mode not in ('L', 'LA'): counters['lossless_gray'] += 1
+
+        if np is not None:
+            trials = [('{}/{}/{}'.format(plan.label, filter_kind, strategy),
+                       partial(write_png, plan, base.size, filter_kind, strategy, image.info))
+                      for plan in plans(base, stats) for filter_kind, strategy in png_candidates(plan, stats)]
+        else:
+            trials = [('{}/{}'.format(label, strategy), partial(_pillow_png, candidate, strategy))
+                      for candidate, strategy, label in _pillow_candidates(base, stats)]
+
+        # 直前の候補と同じだけ時間がかかるとして、予算に収まらなくなったら打ち切る
+        deadline = time.thread_time() + budget
+        best, best_label, cost = None, None, 0.0
+        for label, trial in trials:
+            started = time.thread_time()
+            if best is not None and started + cost > deadline:
+                break
+            data = trial()
+            cost = time.thread_time() - started
+            if counters is not None: counters['lossless_trials'] += 1
+            if best is None or len(data) < len(best):
+                best, best_label = data, label
+        return best, best_label
+
+    def encode_gif(self, image, budget):
+        # GIF の LZW には選べる設定がほとんどないので、インターレースの有無だけを比べる
+        results = []
+        start = time.thread_time()
+        for interlace in (False, True):
+            if results and time.thread_time() - start > budget:
+                break
+            buf = io.BytesIO()
+            image.save(buf, format='GIF', optimize=True, interlace=interlace)
+            results.append((buf.getvalue(), 'gif/interlaced' if interlace else 'gif'))
+        return min(results, key=lambda r: len(r[0]))
+
+engine = LosslessEngine()
+
+def is_animated(image):
+    return getattr(image, 'is_animated', False) and getattr(image, 'n_frames', 1) > 1
+
+def encode_animation(image, fmt, size=None, quality=None):
+    # すべてのフレームを合成済みの RGBA として取り出し（必要なら縮小して）、フレームの時間とループ回数を保って書き直す。
+    # フレーム間の差分は Pillow が書き込み時に求める
+    frames, durations = [], []
+    for frame in ImageSequence.Iterator(image):
+        rgba = frame.convert('RGBA')
+        if size:
+            rgba = rgba.resize(size, Image.Resampling.LANCZOS)
+        frames.append(rgba)
+        durations.append(frame.info.get('duration', image.info.get('duration', 100)))
+    args = {'save_all': True, 'append_images': frames[1:], 'duration': durations, 'loop': image.info.get('loop', 0)}
+    if fmt == 'GIF':
+        args['optimize'] = True
+    elif fmt == 'PNG':
+        args.update({'optimize': True, 'default_image': False})
+    else:
+        args['quality'] = quality
+    buf = io.BytesIO()
+    frames[0].save(buf, format=fmt, **args)
+    return buf.getvalue()
+
+def animation_memory(image, size=None):
+    # すべてのフレームを RGBA で保持するのに必要なバイト数
+    w, h = size or image.size
+    return w * h * 4 * getattr(image, 'n_frames', 1)
@@ -1,5 +1,4 @@
-import os, zipfile, tempfile
-from datetime import datetime, timezone
+from collections import Counter
 from qt.core import QDialog, QVBoxLayout, QLabel, QLineEdit, QPushButton, QComboBox, QCheckBox
 from calibre.gui2.actions import InterfaceAction
 from calibre.gui2 import error_dialog, info_dialog
@@ -7,10 +6,11 @@ from calibre.gui2 import Dispatcher
 from calibre.utils.config import JSONConfig
 from calibre_plugins.image_optimizer import get_resources
 
-from calibre.ebooks.metadata.meta import set_metadata
-
 from . import ImageOptimizerPlugin
-from .optimizer import optimize_image_logic
+from .processing import DEFAULT_PARAMS, run_batch
+from .timing import format_lines, to_json
+from .encoders import encoder_lines
+from .estimate import estimate_books, estimate_summary, estimate_lines
 from .config_dialog import ConfigDialog
 
 from calibre.utils.localization import _
@@ -18,137 +18,7 @@ from calibre.utils.localization import _
 load_translations()  # type: ignore
 
 from .config_dialog import prefs
-prefs.defaults.update({
-    'size': '1080',
-    'quality': '85',
-    'format': _('Original'),
-    'keep_time_import': True
-})
-
-def get_image_type(data):
-    if not data or len(data) < 12:
-        return None
-
-    # 最も一般的なフォーマット
-    if data.startswith(b'\xff\xd8\xff'):
-        return 'jpeg'
-    if data.startswith(b'\x89PNG\r\n\x1a\n'):
-        return 'png'
-    if data.startswith(b'RIFF') and data[8:12] == b'WEBP':
-        return 'webp'
-    if data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
-        return 'gif'
-    
-    # グラフィックおよび技術的なフォーマット
-    if data.startswith(b'BM'):
-        return 'bmp'
-    if data.startswith(b'II\x2a\x00') or data.startswith(b'MM\x00\x2a'):
-        return 'tiff'
-    if data[:4] in (b'\x00\x00\x01\x00', b'\x00\x00\x02\x00'):
-        return 'ico' # .curを含む
-    
-    # モダンおよびHDRフォーマット
-    if data[4:12] in (b'ftypavif', b'ftypavis'):
-        return 'avif'
-    if data.startswith(b'qoif'):
-        return 'qoi'
-    if data.startswith(b'#?RADIANCE') or data.startswith(b'\x0a\x20\x20\x20'):
-        return 'hdr'
-    if data.startswith(b'\x76\x2f\x31\x01'):
-        return 'openexr'
-    
-    # ゲームフォーマットその他
-    if data.startswith(b'DDS '):
-        return 'dds'
-    if data.startswith(b'farbfeld'):
-        return 'farbfeld'
-    if data[:3] in (b'P1\n', b'P2\n', b'P3\n', b'P4\n', b'P5\n', b'P6\n'):
-        return 'pnm' # PBM、PGM、PPMを含む
-    
-    # TGAは先頭にマジックバイトがありません（通常は末尾にあります）、
-    # しかしimageクレートはそれをサポートしているため、必要に応じて 'tga' にフォールバックできます
-    
-    return None
-
-def do_single_optimization(book_id, params, db_path, book_mi, formats_data, abort=None, log=None, notifications=None):
-    optimized_formats = {}
-    stats = {}
-    
-    # 大規模な進行状況を分割するために合計フォーマットを計算
-    total_fmts = len(formats_data)
-    
-    for fmt_idx, (fmt, path) in enumerate(formats_data.items()):
-        if abort and abort.is_set(): break
-        if not path or not os.path.exists(path): continue
-        
-        if zipfile.is_zipfile(path):
-            old_size = os.path.getsize(path)
-            fd, temp_out = tempfile.mkstemp(suffix=f'.{fmt.lower()}')
-            os.close(fd)
-
-            try:
-                with zipfile.ZipFile(path, 'r') as yin, \
-                     zipfile.ZipFile(temp_out, 'w') as yout:
-                    
-                    all_files = yin.namelist()
-                    total_items = len(all_files)
-                    
-                    for item_idx, item in enumerate(yin.infolist()):
-                        # 解凍の途中でユーザーがキャンセルを押したかどうかを確認
-                        if abort and abort.is_set(): break
-                        # これらの特殊ファイルは処理しない（EPUB仕様やCalibre用メタ）
-                        if item.filename in ('calibre_bookmarks.txt'):
-                            continue
-                        
-                        if item.filename == 'mimetype':
-                            data = yin.read(item.filename)
-                            yout.writestr(item, data, compress_type=zipfile.ZIP_STORED)
-                            continue
-
-                        data = yin.read(item.filename)
-                        
-                        # 詳細な進行状況を更新（比率 0.0 -> 1.0）
-                        # 式: (前のフォーマットの進行状況) + (このフォーマットの現在のアイテムの進行状況)
-                        if notifications:
-                            item_progress = item_idx / total_items
-                            # 各ブックフォーマットに重みを均等に分配
-                            overall_progress = (fmt_idx + item_progress) / total_fmts
-                            notifications.put((overall_progress, _("Processing {}: {}").format(fmt, item.filename)))
-
-                        if get_image_type(data):
-                            data = optimize_image_logic(data, params)
-                            yout.writestr(item, data)
-                        else:
-                            # fuck compress deflate detect type
-                            compress = zipfile.ZIP_STORED if item.filename == 'mimetype' else zipfile.ZIP_DEFLATED
-                            yout.writestr(item, data, compress_type=compress)
-
-                # 圧縮後にメタデータを埋め込む
-                try:
-                    if notifications:
-                        notifications.put(((fmt_idx + 0.9) / total_fmts, _("Embedding metadata into {}...").format(fmt)))
-                    with open(temp_out, 'r+b') as f:
-                        set_metadata(f, book_mi, fmt.lower())
-                except Exception as emeta:
-                    if log: log.warning(_("Could not embed metadata into {}: {}").format(fmt, str(emeta)))
-                
-                new_size = os.path.getsize(temp_out)
-                optimized_formats[fmt] = temp_out
-
-                if log:
-                    reduction = ((old_size - new_size) / old_size) * 100 if old_size > 0 else 0
-                    log(_("[{}] {:.1f}KB -> {:.1f}KB (Reduced {:.1f}%)").format(fmt, old_size/1024, new_size/1024, reduction))
-            
-                stats[fmt] = (old_size, new_size)
-            except Exception as e:
-                if log: log.error(_("Error {}: {}").format(fmt, str(e)))
-                if os.path.exists(temp_out): os.remove(temp_out)
-
-    # 最後に100% (1.0) を返すことを確認
-    if notifications:
-        notifications.put((1.0, _("File processing completed.")))
-        
-    return book_mi, optimized_formats, stats, params.get('keep_time_import', True)
+prefs.defaults.update(DEFAULT_PARAMS)
 
 class ImageOptimizerAction(InterfaceAction):
     action_spec = (_('Image Optimizer'), get_icons('images/icon.png'), _('Batch Optimize Images'), None)
@@ -165,72 +35,117 @@ class ImageOptimizerAction(InterfaceAction):
         if not params: return
         ids = [self.gui.library_view.model().id(r) for r in rows]
         self.new_book_ids = []
-        self.total_to_process = len(ids)
         self.summary_report = []
-        self.processed_count = 0
+        self.batch_counters = Counter()
         from calibre.gui2.threaded_jobs import ThreadedJob
-        for book_id in ids:
-            db = self.gui.current_db
-            mi = db.get_metadata(book_id, index_is_id=True, get_cover=True)
-            mi.title = f"{mi.title} [optimized]" # Metadataオブジェクトのタイトルを変更
-            fmts = [f.strip().upper() for f in (db.formats(book_id, index_is_id=True) or '').split(',') if f.strip()]
-            formats_data = {f: db.format_path(book_id, f, index_is_id=True) for f in fmts}
+        db = self.gui.current_db
+        if params.get('dry_run'):
+            # 試し実行: 標本から削減量と時間を見積もるだけで、ライブラリには何も追加しない
             job = ThreadedJob(
-                type_='image_optimizer_single',
-                description=_("Optimizing: {}").format(mi.title),
-                func=do_single_optimization,
-                args=(book_id, params, db.library_path, mi, formats_data),
+                type_='image_optimizer_estimate',
+                description=_("Estimating savings for {} books").format(len(ids)),
+                func=estimate_books,
+                args=(ids, params, db.new_api),
                 kwargs={},
-                callback=Dispatcher(self.on_single_job_finished)
+                callback=Dispatcher(self.on_estimate_finished)
             )
             self.gui.job_manager.run_threaded_job(job)
-
-    def on_single_job_finished(self, job):
-        self.processed_count += 1
-        if not job.failed and job.result:
-            mi, optimized_formats, stats, keep_time_import = job.result
-            if optimized_formats:
-                db = self.gui.current_db
-
-                if not keep_time_import:
-                    mi.timestamp = datetime.now(timezone.utc)
-
-                new_id = db.create_book_entry(mi, add_duplicates=True)
-
-                total_old = 0
-                total_new = 0
-                
-                for fmt, temp_path in optimized_formats.items():
-                    # add_format_with_path は新しい mi.title を使用してファイル .epub/.pdf に名前を付けます
-                    db.new_api.add_format(new_id, fmt, temp_path, run_hooks=False)
-                    self.gui.library_view.model().refresh_ids([new_id])
-                    
-                    old_sz, new_sz = stats.get(fmt, (0, 0))
-                    total_old += old_sz
-                    total_new += new_sz
-
-                # self.gui.library_view.model().books_added(1)
-                if os.path.exists(temp_path):
-                    try: os.remove(temp_path)
-                    except: pass
-                self.new_book_ids.append(new_id)
-                reduction = ((total_old - total_new) / total_old) * 100
-                self.summary_report.append(_("• {}: Reduced {:.1f}%").format(mi.title, reduction))
-
-        if self.processed_count >= self.total_to_process:
-            self.gui.library_view.model().refresh_ids(self.new_book_ids)
-            # if self.new_book_ids: self.gui.library_view.select_rows(self.new_book_ids)
-            # info_dialog(self.gui, "Completed", f"Optimized {len(self.new_book_ids)} books.", show=True)
-            self.show_final_report()
+            return
+        # ブックごとにジョブを作らず、バッチ全体を1つのジョブで処理する（キャンセルも一括）
+        job = ThreadedJob(
+            type_='image_optimizer_batch',
+            description=_("Optimizing {} books").format(len(ids)),
+            func=run_batch,
+            args=(ids, params, db.new_api, Dispatcher(self.on_books_added)),
+            kwargs={},
+            callback=Dispatcher(self.on_batch_finished)
+        )
+        self.gui.job_manager.run_threaded_job(job)
+
+    def on_books_added(self, batch):
+        # ブックの作成とフォーマットの追加は取り込みスレッドで済んでいる。ここではバッチごとに1回だけ表示を更新する
+        new_ids = []
+        for book_id, new_id, result, error in batch:
+            mi, optimized_formats, stats, keep_time_import, counters = result
+            self.batch_counters.update(counters)
+            if error is not None:
+                self.summary_report.append(_("Error {}: {}").format(mi.title, error))
+            if new_id is None:
+                continue
+            new_ids.append(new_id)
+            self.new_book_ids.append(new_id)
+
+            total_old = sum(stats.get(fmt, (0, 0))[0] for fmt in optimized_formats)
+            total_new = sum(stats.get(fmt, (0, 0))[1] for fmt in optimized_formats)
+            reduction = ((total_old - total_new) / total_old) * 100 if total_old else 0
+            self.summary_report.append(_("• {}: Reduced {:.1f}%").format(mi.title, reduction))
+            if counters['skipped'] or counters['kept_original']:
+                self.summary_report.append(_("    {} skipped, {} kept original").format(
+                    counters['skipped'], counters['kept_original']))
+            if counters['too_large']:
+                self.summary_report.append(_("    {} too large, kept unchanged").format(counters['too_large']))
+            if counters['grayscale'] or counters['bilevel']:
+                self.summary_report.append(_("    {} grayscale, {} palette").format(counters['grayscale'], counters['bilevel']))
+            if counters['reused']:
+                self.summary_report.append(_("    {} reused from previous output").format(counters['reused']))
+
+        if new_ids:
+            # new_api で作成したブックは GUI の旧 API のビュー（current_db.data）に入っていないので、先に追加する
+            self.gui.current_db.data.books_added(new_ids)
+            self.gui.library_view.model().books_added(len(new_ids))
+
+    def on_estimate_finished(self, job):
+        if job.failed:
+            return self.gui.job_exception(job, dialog_title=_("Image Optimizer"))
+        estimates, totals = job.result
+        estimates = sorted(estimates, key=lambda e: e.savings_percent, reverse=True)
+        msg = estimate_summary(totals) + "\n\n" + "\n".join(estimate_lines(estimates))
+        info_dialog(self.gui, _("Estimated Savings"), msg, show=True)
+
+    def on_batch_finished(self, job):
+        if job.failed:
+            self.gui.job_exception(job, dialog_title=_("Image Optimizer"))
+        if self.new_book_ids:
+            self.gui.tags_view.recount()
+        # if self.new_book_ids: self.gui.library_view.select_rows(self.new_book_ids)
+        # info_dialog(self.gui, "Completed", f"Optimized {len(self.new_book_ids)} books.", show=True)
+        self.show_final_report()
 
     def show_final_report(self):
         # self.gui.library_view.model().refresh_ids(self.new_book_ids)
         
         report_text = "\n".join(self.summary_report)
         msg = _("Optimized {} books.\n\nChange details:\n{}").format(len(self.new_book_ids), report_text)
+
+        counters = self.batch_counters
+        if counters['cache_hits'] or counters['cache_misses']:
+            msg += "\n\n" + _("Cache: {} hits, {} misses, {:.1f}s encode time saved").format(
+                counters['cache_hits'], counters['cache_misses'], counters['cache_saved_seconds'])
+
+        if counters['grayscale'] or counters['bilevel']:
+            msg += "\n\n" + _("{} images converted to grayscale, {} to a small palette").format(
+                counters['grayscale'], counters['bilevel'])
+
+        if counters['lossless_trials'] or counters['lossless_palette'] or counters['lossless_gray'] or counters['animated']:
+            msg += "\n\n" + _("Lossless: {} images as a palette, {} as grayscale, {} trial encodes, {} animations with all frames").format(
+                counters['lossless_palette'], counters['lossless_gray'], counters['lossless_trials'], counters['animated'])
+
+        if counters['quality_searches']:
+            msg += "\n\n" + _("Quality search: {} images, average quality {:.0f}, {} trial encodes").format(
+                counters['quality_searches'], counters['quality_sum'] / counters['quality_searches'], counters['quality_trials'])
+
+        # 画像ごとに選ばれたエンコーダー（バックエンドと労力）の枚数
+        encoders = encoder_lines(counters)
+        if encoders:
+            msg += "\n\n" + _("Encoders:") + "\n" + "\n".join(encoders)
+
+        # ステージごとの合計時間（詳細には JSON 形式で全体を載せる）
+        timing_lines = format_lines(counters)
+        if timing_lines:
+            msg += "\n\n" + _("Stage timings:") + "\n" + "\n".join(timing_lines)
         
         # 結果ダイアログを表示
-        info_dialog(self.gui, _("Optimization Report"), msg, show=True)
+        info_dialog(self.gui, _("Optimization Report"), msg, det_msg=to_json(counters) if timing_lines else '', show=True)
 
     def get_params_from_dialog(self):
         d = ConfigDialog(self.gui)
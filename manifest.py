@@ -0,0 +1,81 @@
+import json, zipfile
+
+from .cache import params_key
+
+# 出力アーカイブに埋め込むマニフェスト。画像エントリごとに元データの署名・パラメータ・結果を記録し、
+# 次回の実行では変更のないエントリを前回の出力からそのままコピーする
+MANIFEST_NAME = 'META-INF/calibre_image_optimizer.json'
+MANIFEST_VERSION = 1
+
+# 最適化したブックに付ける識別子（値は元のブックの UUID）
+SOURCE_IDENTIFIER = 'image_optimizer'
+
+def signature(item):
+    # 元データの署名は中央ディレクトリの CRC32 とサイズ（エントリを解凍せずに比較できる）
+    return [item.CRC, item.file_size]
+
+class Manifest:
+    def __init__(self, params):
+        self.params = params_key(params)
+        self.entries = {}
+
+    def add(self, filename, source, result):
+        self.entries[filename] = {'source': source, 'params': self.params, 'result': result}
+
+    def dumps(self):
+        return json.dumps({'version': MANIFEST_VERSION, 'entries': self.entries}, sort_keys=True)
+
+    def write(self, yout):
+        yout.writestr(MANIFEST_NAME, self.dumps(), compress_type=zipfile.ZIP_DEFLATED)
+
+class PreviousOutput:
+    # 前回の出力アーカイブ。マニフェストと一致するエントリを探す
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, 'r')
+        self.entries = {}
+        try:
+            data = json.loads(self.zip.read(MANIFEST_NAME))
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data.get('entries', {})
+        except (KeyError, ValueError):
+            pass
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def find(self, item, params):
+        # 元データとパラメータが変わっていなければ、前回の出力エントリを返す
+        entry = self.entries.get(item.filename)
+        if not entry or entry['source'] != signature(item) or entry['params'] != params:
+            return None
+        try:
+            previous = self.zip.getinfo(item.filename)
+        except KeyError:
+            return None
+        if [previous.CRC, previous.file_size] != entry['result']:
+            return None
+        return previous
+
+def open_previous(path):
+    if not path or not zipfile.is_zipfile(path):
+        return None
+    try:
+        return PreviousOutput(path)
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+def previous_outputs(db):
+    # 元のブックの UUID -> 最後に最適化したブックの ID
+    found = {}
+    identifiers = db.all_field_for('identifiers', db.all_book_ids())
+    for book_id, ids in identifiers.items():
+        source = (ids or {}).get(SOURCE_IDENTIFIER)
+        if source:
+            found[source] = max(found.get(source, 0), book_id)
+    return found
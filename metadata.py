@@ -0,0 +1,102 @@
+import os, io, posixpath
+
+from .classify import opf_path
+
+# EPUB のメタデータを、最適化したアーカイブを書き込むのと同じパスで埋め込む。
+# 内容は calibre.ebooks.metadata.epub.set_metadata と同じ（OPF の更新と表紙の置き換え）で、
+# 書き込み後にアーカイブ全体をもう一度読み書きする必要がなくなる
+
+ENCRYPTION_NAME = 'META-INF/encryption.xml'
+# calibre が表紙を置き換える拡張子
+COVER_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# calibre の EPUB メタデータ書き込みプラグイン
+EPUB_WRITER = 'Set EPUB metadata'
+
+class EmbeddedMetadata:
+    def __init__(self, replacements):
+        self.replacements = replacements  # {zip 内のパス: bytes}
+
+    def __contains__(self, name):
+        return name in self.replacements
+
+    def pop(self, name):
+        return self.replacements.pop(name)
+
+    def write_missing(self, yout, compress_type):
+        # アーカイブになかったエントリ（新しく追加された表紙）は最後に追加する
+        for name, data in self.replacements.items():
+            yout.writestr(name, data, compress_type=compress_type)
+        self.replacements.clear()
+
+def _cover_data(mi):
+    new_cdata = None
+    try:
+        new_cdata = mi.cover_data[1]
+        if not new_cdata:
+            raise Exception('no cover')
+    except Exception:
+        try:
+            with open(mi.cover, 'rb') as f:
+                new_cdata = f.read()
+        except Exception:
+            pass
+    return new_cdata
+
+def _writer_options():
+    # 書き込みプラグインが無効なら None、有効なら add_missing_cover の値
+    # site_customization は calibre が set_file_type_metadata の実行中だけ設定するので、
+    # calibre と同じく保存されている設定から読む
+    try:
+        from calibre.customize.ui import config, find_plugin, is_disabled
+        plugin = find_plugin(EPUB_WRITER)
+    except Exception:
+        return True
+    if plugin is None:
+        return True
+    if is_disabled(plugin):
+        return None
+    try:
+        customization = config['plugin_customization'].get(plugin.name, '')
+    except Exception:
+        customization = ''
+    return 'disable-add-missing-cover' != (customization or '')
+
+def _read_replacement(obj):
+    # serialize_cover_data はファイルオブジェクトを返す（一時ファイルの場合は削除する）
+    try:
+        obj.seek(0)
+        return obj.read()
+    finally:
+        obj.close()
+        name = getattr(obj, 'name', None)
+        if isinstance(name, str) and os.path.exists(name):
+            os.remove(name)
+
+def prepare_metadata(yin, mi, fmt):
+    # 1回のパスで埋め込めない場合は None を返す（従来どおり書き込み後に set_metadata を使う）
+    if fmt.upper() != 'EPUB' or ENCRYPTION_NAME in yin.NameToInfo:
+        return None
+    path = opf_path(yin)
+    if not path or path not in yin.NameToInfo:
+        return None
+    add_missing_cover = _writer_options()
+    if add_missing_cover is None:
+        return EmbeddedMetadata({})
+
+    from calibre.ebooks.metadata.opf import set_metadata as set_metadata_opf
+    new_cdata = _cover_data(mi)
+    prefix = posixpath.dirname(path)
+    opfbytes, _ver, raster_cover = set_metadata_opf(
+        io.BytesIO(yin.read(path)), mi, cover_prefix=prefix, cover_data=new_cdata,
+        apply_null=False, update_timestamp=False, force_identifiers=False, add_missing_cover=add_missing_cover)
+    replacements = {path: opfbytes}
+    if raster_cover:
+        try:
+            cpath = posixpath.join(prefix, raster_cover)
+            if os.path.splitext(cpath)[1].lower() in COVER_EXTENSIONS:
+                from calibre.ebooks.metadata.epub import serialize_cover_data
+                replacements[cpath] = _read_replacement(serialize_cover_data(new_cdata, cpath))
+        except Exception:
+            import traceback
+            traceback.print_exc()
+    return EmbeddedMetadata(replacements)
@@ -0,0 +1,98 @@
+import os, struct
+
+# MOBI / AZW3 (Palm Database) の画像レコードを書き換える。
+# レコードは番号で参照されるので、レコード一覧のオフセットを書き直せば中身の大きさを変えられる。
+# ファイルはレコード単位で読み書きし、ブック全体をメモリに読み込まない
+
+# PDB ヘッダー: 名前(32) 属性(2) バージョン(2) 日付(4x3) 修正番号(4) appinfo(4) sortinfo(4) タイプ(4) 作成者(4) ...
+PDB_HEADER_SIZE = 78
+PDB_TYPE_OFFSET = 60
+PDB_COUNT_OFFSET = 76
+RECORD_ENTRY = struct.Struct('>I4s')  # オフセット、属性 + ユニーク ID
+# レコード0: PalmDOC ヘッダー(16) の後に MOBI ヘッダーが続き、最初の画像（リソース）のレコード番号を持つ
+MOBI_MAGIC_OFFSET = 16
+MOBI_LENGTH_OFFSET = 20
+FIRST_IMAGE_OFFSET = 0x6C
+NO_IMAGES = 0xFFFFFFFF
+# レコード0として読み込む最大のサイズ（MOBI ヘッダーと EXTH を含む）
+RECORD0_READ = 64 * 1024
+
+MOBI_FORMATS = ('MOBI', 'AZW', 'AZW3', 'PRC')
+# MOBI の画像レコードとして扱う先頭のバイト（JPEG、GIF、PNG）
+IMAGE_MAGIC = (b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'\x89PNG\r\n\x1a\n')
+
+def read_header(f):
+    # (PDB ヘッダー, [(オフセット, 属性), ...], ファイルサイズ)。MOBI でなければ None
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    header = f.read(PDB_HEADER_SIZE)
+    if len(header) < PDB_HEADER_SIZE or header[PDB_TYPE_OFFSET:PDB_TYPE_OFFSET + 8] != b'BOOKMOBI':
+        return None
+    count, = struct.unpack_from('>H', header, PDB_COUNT_OFFSET)
+    table = f.read(RECORD_ENTRY.size * count)
+    if len(table) < RECORD_ENTRY.size * count:
+        return None
+    records = [RECORD_ENTRY.unpack_from(table, i * RECORD_ENTRY.size) for i in range(count)]
+    offsets = [offset for offset, _attrs in records]
+    if not records or offsets != sorted(offsets) or offsets[-1] > size:
+        return None
+    return header, records, size
+
+def first_image_index(f, records, size):
+    end = records[1][0] if len(records) > 1 else size
+    f.seek(records[0][0])
+    record0 = f.read(min(end - records[0][0], RECORD0_READ))
+    if record0[MOBI_MAGIC_OFFSET:MOBI_MAGIC_OFFSET + 4] != b'MOBI':
+        return None
+    length, = struct.unpack_from('>I', record0, MOBI_LENGTH_OFFSET)
+    if MOBI_MAGIC_OFFSET + length < FIRST_IMAGE_OFFSET + 4 or len(record0) < FIRST_IMAGE_OFFSET + 4:
+        return None
+    index, = struct.unpack_from('>I', record0, FIRST_IMAGE_OFFSET)
+    return None if index == NO_IMAGES else index
+
+class MobiAdapter:
+    formats = MOBI_FORMATS
+    requirement = None
+    # MOBI のリーダーが対応するフォーマットのままにする（WebP などへの変換はしない）
+    keep_format = True
+
+    def available(self):
+        return True
+
+    def matches(self, fmt, path):
+        if fmt.upper() not in self.formats:
+            return False
+        try:
+            with open(path, 'rb') as f:
+                return read_header(f) is not None
+        except OSError:
+            return False
+
+    def rewrite(self, path, temp_out, optimize, progress=None, label='', counters=None):
+        # optimize([(key, 画像のデータ or None, 元のデータ), ...]) は (key, 出力 or None, 元のデータ) を同じ順序で返す
+        with open(path, 'rb') as f, open(temp_out, 'wb') as out:
+            header, records, size = read_header(f)
+            first_image = first_image_index(f, records, size)
+            ends = [offset for offset, _attrs in records[1:]] + [size]
+
+            # ヘッダー・レコード一覧と最初のレコードまでの隙間は同じ大きさなので、そのまま書いて後で一覧を更新する
+            f.seek(0)
+            out.write(f.read(records[0][0]))
+
+            def read_records():
+                for index, ((offset, _attrs), end) in enumerate(zip(records, ends)):
+                    f.seek(offset)
+                    data = f.read(end - offset)
+                    is_image = first_image is not None and index >= first_image and data.startswith(IMAGE_MAGIC)
+                    yield index, data if is_image else None, data
+
+            new_offsets = []
+            for index, output, original in optimize(read_records()):
+                new_offsets.append(out.tell())
+                out.write(original if output is None else output)
+                if progress is not None and progress.advance(len(original), 0 if output is None else 1):
+                    progress.update(label)
+
+            out.seek(PDB_HEADER_SIZE)
+            out.write(b''.join(RECORD_ENTRY.pack(offset, attrs) for offset, (_old, attrs) in zip(new_offsets, records)))
@@ -3,68 +3,257 @@ from PIL import Image
 
 from calibre.utils.localization import _
 
+from .cache import get_cache
+from .scheduler import parse_mb
+from .timing import stage
+from .grayscale import parse_threshold, probe_grayscale, reduce_mode
+from .quality import LOSSY_FORMATS, QUALITY_FIXED, quality_mode, parse_target, search_quality
+from .encoders import ENCODER_AUTO, encoder_setting, normalize_format, select_encoder, encode_with, record
+from . import lossless
+
 load_translations()  # type: ignore
 
-def optimize_image_logic(img_data, params):
+# 最終的な LANCZOS リサンプリングの前に、目標サイズの何倍までを整数縮小（reduce）で済ませるか。
+# 2.0 で従来の出力に対して PSNR 40 dB 以上を保つ（benchmarks/resize.py で検証）
+REDUCING_GAP = 2.0
+
+# 分割リサンプリングで1回に出力する最小の行数
+STRIP_MIN_ROWS = 16
+
+def pixel_depth(image):
+    # Pillow は複数チャンネルの画像を 1 ピクセル 4 バイトで保持する
+    return 4 if len(image.getbands()) > 1 else 1
+
+def parse_max_pixels(params):
+    # 画素数の上限（メガピクセル、0 = 無制限）
+    try:
+        return max(0, int(float(params.get('max_megapixels', 0)) * 1000000))
+    except (TypeError, ValueError):
+        return 0
+
+def target_size(w, h, max_px_size):
+    # 短辺を max_px_size に合わせた大きさ（縮小不要なら None）
+    if max_px_size is None:
+        return None
+    if w < h:
+        if w > max_px_size:
+            return int(max_px_size), int(h * (max_px_size / w))
+    elif h > max_px_size:
+        return int(w * (max_px_size / h)), int(max_px_size)
+    return None
+
+def draft(image, size):
+    # JPEG は DCT 領域で 1/2・1/4・1/8 にデコードし、フル解像度のデコードを避ける
+    # （デコード結果は目標サイズの REDUCING_GAP 倍以上が保証される）。デコード前に呼ぶこと
+    if image.format == 'JPEG':
+        image.draft(None, (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP)))
+
+def downscale(image, size, budget=0):
+    draft(image, size)
+    return resize_bounded(image, size, budget)
+
+def resize_bounded(image, size, budget=0):
+    # 横方向の中間バッファ（出力の幅 x 元の高さ）と出力が budget バイトに収まらない場合は、
+    # 出力を横長の帯に分けてリサンプリングする。box で元画像の範囲を指定するので、一括の場合と見た目は同等になる
+    # （帯の境界では丸め誤差の範囲で値が異なることがある）
+    w, h = image.size
+    nw, nh = size
+    depth = pixel_depth(image)
+    decoded = w * h * depth
+    if not budget or image.mode in ('1', 'P') or decoded + (nw * h + nw * nh) * depth <= budget:
+        return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+
+    scale = h / nh
+    available = max(0, budget - decoded - nw * nh * depth)
+    rows = max(STRIP_MIN_ROWS, int(available / (nw * depth * scale)))
+    output = Image.new(image.mode, size)
+    output.info = dict(image.info)
+    for top in range(0, nh, rows):
+        bottom = min(nh, top + rows)
+        strip = image.resize((nw, bottom - top), Image.Resampling.LANCZOS,
+                             box=(0, top * scale, w, bottom * scale), reducing_gap=REDUCING_GAP)
+        output.paste(strip, (0, top))
+        del strip
+    return output
+
+# IJG 標準の輝度量子化テーブル（品質 50）。合計値は係数の並び順に依存しない
+_STD_LUMA_TABLE_SUM = sum((
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+))
+
+def estimate_jpeg_quality(image):
+    # 量子化テーブルから IJG 品質値を逆算する（Image.open 直後、デコード前に利用可能）
+    tables = getattr(image, 'quantization', None)
+    if not tables or 0 not in tables:
+        return None
+    scale = sum(tables[0]) * 100.0 / _STD_LUMA_TABLE_SUM
+    if scale <= 0:
+        return 100
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return max(1, min(100, int(round(quality))))
+
+def is_already_optimal(image, target_format, quality, max_px_size):
+    # ヘッダーのみで判定: 縮小不要・同じフォーマット・要求品質以下で圧縮済みの JPEG は再エンコードしても改善しない
+    if image.format != 'JPEG' or target_format.upper() not in ('JPEG', 'JPG'):
+        return False
+    if max_px_size is not None and min(image.size) > max_px_size:
+        return False
+    estimated = estimate_jpeg_quality(image)
+    return estimated is not None and estimated <= quality
+
+def estimate_memory(img_data, params=None):
+    # デコード後のピクセルバッファの推定サイズ（ヘッダーのみ読む）。元画像と縮小・変換後の2枚分。
+    # params を指定すると、縮小デコードと1枚あたりのメモリ上限を考慮する
+    params = params or {}
+    try:
+        with Image.open(io.BytesIO(img_data)) as image:
+            w, h = image.size
+            max_pixels = parse_max_pixels(params)
+            if max_pixels and w * h > max_pixels:
+                return len(img_data)  # デコードせずにそのまま残す
+            size = params.get('size')
+            new_size = target_size(w, h, float(size)) if size else None
+            if new_size:
+                draft(image, new_size)
+                w, h = image.size
+            depth = pixel_depth(image)
+    except Exception:
+        return len(img_data)
+    memory = w * h * depth * 2
+    budget = parse_mb(params.get('image_memory'))
+    if budget:
+        memory = min(memory, budget)
+    return memory + len(img_data)
+
+def optimize_image_logic(img_data, params, counters=None):
+    # 同じ入力とパラメータの組み合わせはキャッシュから返す
+    cache = get_cache(params.get('cache_size'))
+    if cache is None:
+        return encode_image(img_data, params, counters)
+    return cache.fetch(img_data, params, encode_image, counters)
+
+def encode_image(img_data, params, counters=None):
     try:
         image = Image.open(io.BytesIO(img_data))
         orig_format = image.format
         w, h = map(float, image.size)
 
+        # 画素数の上限を超える画像（巨大なスキャンや解凍爆弾）はデコードせずにそのまま残す
+        max_pixels = parse_max_pixels(params)
+        if max_pixels and w * h > max_pixels:
+            if counters is not None: counters['too_large'] += 1
+            return img_data
+
         quality = int(params.get('quality', 100)) if params.get('quality') != '' else 100
         encoding_type = params.get('format', _("Original"))
         
         target_format = encoding_type if encoding_type != _("Original") else orig_format
         if not target_format: target_format = 'JPEG' # 安全なフォールバック
 
-        if params.get('size') != '':
-            max_px_size = float(params.get('size'))
-            if w < h:
-              if w > max_px_size:
-                new_w = max_px_size
-                new_h = h * (max_px_size / w)
-                image = image.resize((int(new_w), int(new_h)), Image.Resampling.LANCZOS)
-            else:
-              if h > max_px_size:
-                new_h = max_px_size
-                new_w = w * (max_px_size / h)
-                image = image.resize((int(new_w), int(new_h)), Image.Resampling.LANCZOS)
+        max_px_size = float(params.get('size')) if params.get('size') != '' else None
+
+        # デコードする前に、再エンコードで改善しないことがヘッダーから分かれば元のデータを返す
+        # （グレースケールに変換できる RGB の画像は除く）
+        grayscale_threshold = parse_threshold(params)
+        if is_already_optimal(image, target_format, quality, max_px_size) and \
+                not (image.mode == 'RGB' and probe_grayscale(img_data, grayscale_threshold)):
+            if counters is not None: counters['skipped'] += 1
+            return img_data
+
+        new_size = target_size(w, h, max_px_size)
+
+        # ステージごとの計測（無効時はほぼコストなし）
+        timings = params.get('timings')
+        scope = (orig_format or 'unknown').lower()
+
+        # JPEG は縮小デコードした後の大きさで、1枚あたりのメモリ上限に収まるか確認する
+        budget = parse_mb(params.get('image_memory'))
+
+        # アニメーションはすべてのフレームを残す。フレームを持てないフォーマットには変換しない
+        if lossless.is_animated(image):
+            fmt_upper = normalize_format(target_format)
+            if fmt_upper not in lossless.ANIMATION_FORMATS or \
+                    budget and lossless.animation_memory(image, new_size) > budget:
+                if counters is not None: counters['kept_original'] += 1
+                return img_data
+            with stage(counters, timings, scope, 'encode') as encoding:
+                output = lossless.encode_animation(image, fmt_upper, new_size, quality)
+                encoding.nbytes = len(output)
+            if counters is not None: counters['animated'] += 1
+            if len(output) >= len(img_data):
+                if counters is not None: counters['kept_original'] += 1
+                return img_data
+            return output
+
+        if new_size:
+            draft(image, new_size)
+        if budget and image.width * image.height * pixel_depth(image) > budget:
+            if counters is not None: counters['too_large'] += 1
+            return img_data
+
+        with stage(counters, timings, scope, 'decode', len(img_data)):
+            image.load()
+        if new_size:
+            with stage(counters, timings, scope, 'resize'):
+                image = resize_bounded(image, new_size, budget)
+
+        # 見た目がグレースケールなら1チャンネル（2値の線画はパレット）にしてからエンコードする
+        with stage(counters, timings, scope, 'color'):
+            image = reduce_mode(image, target_format, grayscale_threshold, counters)
 
-        buf = io.BytesIO()
-        save_args = {'optimize': True}
-        fmt_upper = target_format.upper()
+        fmt_upper = normalize_format(target_format)
 
         # 特定のカラーモードを処理
         # JPEG/BMP/EPS はアルファチャンネル（透明度）をサポートしていません
-        if fmt_upper in ('JPEG', 'JPG', 'BMP', 'EPS'):
+        if fmt_upper in ('JPEG', 'BMP', 'EPS'):
             if image.mode in ("RGBA", "P", "LA"):
                 image = image.convert('RGB')
-        
-        # フォーマットごとの圧縮パラメータを設定
-        if fmt_upper in ('JPEG', 'JPG'):
-            save_args.update({'quality': quality, 'progressive': True, 'subsampling': '4:2:0', 'keep_rgb': False})
-        elif fmt_upper == 'WEBP':
-            save_args.update({'quality': quality, 'method': 6})
-        elif fmt_upper == 'PNG':
-            save_args.update({'compress_level': 9}) # PNGは品質の代わりに圧縮レベルを使用
-        elif fmt_upper == 'TIFF':
-            save_args.update({'compression': 'tiff_lzw'})
-        elif fmt_upper == 'GIF':
-            # アニメーションGIFの場合は image.save(..., save_all=True) を使用する必要がありますが、ここでは単一フレームのみを最適化しますか？
-            # 元のコードには 'interlace': True のみが含まれていました。
-            save_args.update({'interlace': True})
-        else:
-            # QOI, TGA, BMP などの他のフォーマットは品質を使用しません
-            pass
-
-        # "unexpected keyword argument" エラーを避けるために柔軟なパラメータを使用
-        try:
-            image.save(buf, format=target_format, **save_args)
-        except (ValueError, TypeError):
-            # 'optimize' をサポートしていない奇妙なフォーマットの場合は、純粋に保存を試みる
-            image.save(buf, format=target_format)
-
-        return buf.getvalue()
+
+        # SSIM の下限または1枚あたりのサイズが指定されている場合は、品質を探索する
+        mode = quality_mode(params)
+        target = parse_target(params, mode) if fmt_upper in LOSSY_FORMATS else None
+
+        # PNG・GIF は、バックエンドが自動選択なら可逆圧縮エンジンで最も小さい出力を探す
+        lossless_budget = lossless.parse_budget(params)
+        use_lossless = fmt_upper in lossless.LOSSLESS_FORMATS and lossless_budget > 0 and \
+            encoder_setting(params) == ENCODER_AUTO
+
+        with stage(counters, timings, scope, 'encode') as encoding:
+            result = lossless.engine.encode(image, fmt_upper, lossless_budget, counters) if use_lossless else None
+            if result is not None:
+                output, label = result
+                record(counters, lossless.engine, label)
+            else:
+                # フォーマットと品質ごとに、基準と同等の出力になる最も速いバックエンドと労力を使う
+                encoder, effort = select_encoder(image, fmt_upper, quality, params, counters)
+                if target is not None and mode != QUALITY_FIXED:
+                    def encode(trial_image, trial_quality):
+                        # 試しのエンコードは別のスレッドで実行されるので、カウンターには書かない
+                        return encode_with(encoder, effort, trial_image, fmt_upper, trial_quality)
+                    _quality, output = search_quality(image, encode, quality, mode, target, counters)
+                    record(counters, encoder, effort)
+                else:
+                    output = encode_with(encoder, effort, image, fmt_upper, quality, counters)
+            encoding.nbytes = len(output)
+
+        # 新しいエンコードが元より小さくならない場合は元のバイト列を残す
+        if len(output) >= len(img_data):
+            if counters is not None: counters['kept_original'] += 1
+            return img_data
+
+        return output
+
+    except Image.DecompressionBombError:
+        # Pillow 自体の上限を超える画像
+        if counters is not None: counters['too_large'] += 1
+        return img_data
 
     except Exception as e:
         print(f"Optimization error: {str(e)}") # エラーメッセージは翻訳済み
@@ -0,0 +1,82 @@
+import io
+from PIL import Image
+
+try:
+    import pikepdf
+except ImportError:
+    # pikepdf がない場合、PDF はスキップする（ログに記録する）
+    pikepdf = None
+
+# PDF の画像 XObject のうち、JPEG (DCTDecode) で格納されているものを書き換える。
+# pikepdf はオブジェクトを必要なときにファイルから読むので、ブック全体をメモリに読み込まない。
+# 縮小しても描画される大きさはページの変換行列で決まるので、Width/Height を更新するだけでよい
+
+# そのまま JPEG として取り出せる色空間と成分数
+DEVICE_COMPONENTS = {'/DeviceGray': 1, '/DeviceRGB': 3}
+
+def _components(colorspace):
+    # 対応する色空間の成分数（1 または 3）。それ以外（CMYK、Indexed、Lab など）は None
+    if isinstance(colorspace, pikepdf.Name):
+        return DEVICE_COMPONENTS.get(str(colorspace))
+    if isinstance(colorspace, pikepdf.Array) and len(colorspace) == 2 and colorspace[0] == pikepdf.Name.ICCBased:
+        n = int(colorspace[1].get('/N', 0))
+        return n if n in (1, 3) else None
+    return None
+
+def _filters(obj):
+    value = obj.get('/Filter')
+    if value is None:
+        return []
+    return [value] if isinstance(value, pikepdf.Name) else list(value)
+
+def eligible(obj):
+    # 成分数を返す。対応しない画像は None
+    if obj.get('/Subtype') != pikepdf.Name.Image or _filters(obj) != [pikepdf.Name.DCTDecode]:
+        return None
+    if obj.get('/ImageMask', False) or '/Decode' in obj or '/DecodeParms' in obj:
+        return None
+    if int(obj.get('/BitsPerComponent', 8)) != 8 or isinstance(obj.get('/Mask'), pikepdf.Array):
+        return None
+    return _components(obj.get('/ColorSpace'))
+
+class PdfAdapter:
+    formats = ('PDF',)
+    requirement = 'pikepdf'
+    # PDF に埋め込めるのは JPEG のまま（DCTDecode）
+    output_format = 'JPEG'
+
+    def available(self):
+        return pikepdf is not None
+
+    def matches(self, fmt, path):
+        return fmt.upper() in self.formats
+
+    def rewrite(self, path, temp_out, optimize, progress=None, label='', counters=None):
+        with pikepdf.open(path) as pdf:
+            def read_images():
+                for obj in pdf.objects:
+                    if not isinstance(obj, pikepdf.Stream) or obj.get('/Subtype') != pikepdf.Name.Image:
+                        continue
+                    components = eligible(obj)
+                    if components is None:
+                        if counters is not None: counters['unsupported_images'] += 1
+                        continue
+                    yield obj, obj.read_raw_bytes(), components
+
+            for obj, output, components in optimize(read_images()):
+                original = int(obj.get('/Length', 0))
+                if progress is not None and progress.advance(original, 1):
+                    progress.update(label)
+                if output is None or len(output) >= original:
+                    continue
+                with Image.open(io.BytesIO(output)) as image:
+                    size, mode = image.size, image.mode
+                if mode not in ('L', 'RGB') or (mode == 'RGB' and components == 1):
+                    continue
+                obj.write(output, filter=pikepdf.Name.DCTDecode)
+                obj.Width, obj.Height = size
+                obj.BitsPerComponent = 8
+                if mode == 'L' and components == 3:
+                    # グレースケールに変換した画像
+                    obj.ColorSpace = pikepdf.Name.DeviceGray
+            pdf.save(temp_out)
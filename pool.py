@@ -0,0 +1,116 @@
+import os, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+# ジョブをまたいで生き続けるワーカープール。
+# Pillow はデコード・リサイズ・エンコード中に GIL を解放するため、スレッドでも複数コアを使い切れる。
+# calibre のプラグインは zip から独自インポーターで読み込まれるので、子プロセスからは import できない。
+_lock = threading.Lock()
+# ワーカー数ごとのプール。別のバッチや試し実行が使っている可能性があるので、ワーカー数が変わっても停止しない
+_executors = {}
+# 1枚の画像の品質探索で試しにエンコードするためのプール。
+# 画像のタスクから投入して完了を待つので、同じプールを使うとデッドロックする
+_trial_executor = None
+
+# abort を確認する間隔（秒）
+POLL_INTERVAL = 0.1
+
+class MemoryBudget:
+    # 同時に処理中のタスクが使う推定メモリ量を制限する（0 = 無制限）。バッチごとに1つ作り、map_ordered に渡す。
+    # 予約はタスクの完了時に解放されるので、結果を受け取る側の順序に関係なくデッドロックしない
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, amount, abort=None):
+        with self._cond:
+            # 予算より大きいタスクも、他に処理中のタスクがなければ実行する
+            while self.limit and self.in_use and self.in_use + amount > self.limit:
+                if abort is not None and abort.is_set():
+                    return False
+                self._cond.wait(POLL_INTERVAL)
+            self.in_use += amount
+            return True
+
+    def release(self, amount):
+        with self._cond:
+            self.in_use -= amount
+            self._cond.notify_all()
+
+def default_workers():
+    return max(1, (os.cpu_count() or 2) - 1)
+
+def resolve_workers(value):
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        workers = 0
+    return workers if workers > 0 else default_workers()
+
+def get_pool(workers=None):
+    workers = resolve_workers(workers)
+    with _lock:
+        executor = _executors.get(workers)
+        if executor is None:
+            executor = _executors[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image_optimizer')
+        return executor, workers
+
+def get_trial_pool():
+    global _trial_executor
+    with _lock:
+        if _trial_executor is None:
+            _trial_executor = ThreadPoolExecutor(max_workers=default_workers() + 2, thread_name_prefix='image_optimizer_trial')
+        return _trial_executor
+
+def shutdown():
+    global _trial_executor
+    with _lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        if _trial_executor is not None:
+            _trial_executor.shutdown(wait=False, cancel_futures=True)
+        _executors.clear()
+        _trial_executor = None
+
+def map_ordered(func, iterable, workers=None, abort=None, weigh=None, budget=None):
+    # func(*args) を並列に実行し、結果を入力と同じ順序で返す。
+    # メモリを抑えるため、同時に保持するタスクはワーカー数の2倍まで。
+    # budget (MemoryBudget) と weigh(*args) を指定すると、その推定メモリ量を budget から予約する
+    executor, workers = get_pool(workers)
+    window = workers * 2
+    pending = deque()
+
+    def aborted():
+        return abort is not None and abort.is_set()
+
+    def wait(future):
+        while True:
+            try:
+                return True, future.result(timeout=POLL_INTERVAL)
+            except FutureTimeout:
+                if aborted(): return False, None
+
+    try:
+        for args in iterable:
+            if aborted(): return
+            if weigh is None or budget is None:
+                future = executor.submit(func, *args)
+            else:
+                amount = weigh(*args)
+                if not budget.acquire(amount, abort): return
+                future = executor.submit(func, *args)
+                future.add_done_callback(lambda _f, amount=amount: budget.release(amount))
+            pending.append(future)
+            while len(pending) >= window:
+                ok, result = wait(pending.popleft())
+                if not ok: return
+                yield result
+        while pending:
+            ok, result = wait(pending.popleft())
+            if not ok: return
+            yield result
+    finally:
+        # キャンセルまたは途中終了時は未開始のタスクを破棄する
+        for future in pending:
+            future.cancel()
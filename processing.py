@@ -0,0 +1,387 @@
+import os, zipfile, tempfile
+from collections import Counter
+
+from calibre.ebooks.metadata.meta import set_metadata
+
+from .optimizer import optimize_image_logic, estimate_memory
+from .pool import map_ordered, MemoryBudget
+from .scheduler import BookScheduler, parse_mb, parse_count
+from .zipstream import sniff_entry, copy_entry, copy_raw
+from .manifest import Manifest, MANIFEST_NAME, SOURCE_IDENTIFIER, signature, open_previous, previous_outputs
+from .timing import stage, format_lines
+from .encoders import encoder_lines
+from .classify import EntryClassifier
+from .metadata import prepare_metadata
+from .ingest import Ingestor, create_staging_dir, remove_staging_dir, preflight
+from .estimate import filter_books
+from .progress import Progress
+from .adapters import find_adapter, rewrite
+
+from calibre.utils.localization import _
+
+load_translations()  # type: ignore
+
+# GUI に依存しない処理（ツールバーのアクションとコマンドラインの両方から使う）
+
+DEFAULT_PARAMS = {
+    'size': '1080',
+    'quality': '85',
+    'format': _('Original'),
+    'quality_mode': 'fixed',
+    'target_ssim': '0.95',
+    'target_kb': '300',
+    'grayscale_threshold': '8',
+    'encoder': 'auto',
+    'lossless_budget': '1',
+    'image_memory': '256',
+    'max_megapixels': '150',
+    'min_savings': '0',
+    'dry_run': False,
+    'keep_time_import': True,
+    'workers': '0',
+    'cache_size': '512',
+    'books_in_flight': '2',
+    'memory_budget': '1024',
+    'disk_budget': '4096',
+    'incremental': True,
+    'timings': False
+}
+
+def get_image_type(data):
+    if not data or len(data) < 12:
+        return None
+
+    # 最も一般的なフォーマット
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data.startswith(b'RIFF') and data[8:12] == b'WEBP':
+        return 'webp'
+    if data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
+        return 'gif'
+    
+    # グラフィックおよび技術的なフォーマット
+    if data.startswith(b'BM'):
+        return 'bmp'
+    if data.startswith(b'II\x2a\x00') or data.startswith(b'MM\x00\x2a'):
+        return 'tiff'
+    if data[:4] in (b'\x00\x00\x01\x00', b'\x00\x00\x02\x00'):
+        return 'ico' # .curを含む
+    
+    # モダンおよびHDRフォーマット
+    if data[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'avif'
+    if data.startswith(b'qoif'):
+        return 'qoi'
+    if data.startswith(b'#?RADIANCE') or data.startswith(b'\x0a\x20\x20\x20'):
+        return 'hdr'
+    if data.startswith(b'\x76\x2f\x31\x01'):
+        return 'openexr'
+    
+    # ゲームフォーマットその他
+    if data.startswith(b'DDS '):
+        return 'dds'
+    if data.startswith(b'farbfeld'):
+        return 'farbfeld'
+    if data[:3] in (b'P1\n', b'P2\n', b'P3\n', b'P4\n', b'P5\n', b'P6\n'):
+        return 'pnm' # PBM、PGM、PPMを含む
+    
+    # TGAは先頭にマジックバイトがありません（通常は末尾にあります）、
+    # しかしimageクレートはそれをサポートしているため、必要に応じて 'tga' にフォールバックできます
+    
+    return None
+
+def optimize_entry(item, data, params):
+    # ワーカースレッドで実行される。data が None のエントリは画像ではないのでそのまま返す
+    # カウンターはタスクごとに作成し、メインスレッドで集計する
+    counters = Counter()
+    if data is None:
+        return item, None, False, counters
+    return item, optimize_image_logic(data, params, counters), True, counters
+
+def entry_memory(item, data, params):
+    return 0 if data is None else estimate_memory(data, params)
+
+def embed_metadata(temp_out, book_mi, fmt, counters, timings, progress, log):
+    try:
+        progress.update(_("Embedding metadata into {}...").format(fmt))
+        with stage(counters, timings, fmt.lower(), 'metadata', os.path.getsize(temp_out)), open(temp_out, 'r+b') as f:
+            set_metadata(f, book_mi, fmt.lower())
+    except Exception as emeta:
+        if log: log.warning(_("Could not embed metadata into {}: {}").format(fmt, str(emeta)))
+
+def format_stats(fmt, old_size, temp_out, log):
+    new_size = os.path.getsize(temp_out)
+    if log:
+        reduction = ((old_size - new_size) / old_size) * 100 if old_size > 0 else 0
+        log(_("[{}] {:.1f}KB -> {:.1f}KB (Reduced {:.1f}%)").format(fmt, old_size/1024, new_size/1024, reduction))
+    return old_size, new_size
+
+def do_single_optimization(book_id, params, db_path, book_mi, formats_data, abort=None, log=None, notifications=None, previous_formats=None, staging_dir=None, memory_budget=None):
+    # memory_budget (MemoryBudget) はバッチ内で同時に処理中の画像のメモリを制限する（None = 無制限）
+    optimized_formats = {}
+    stats = {}
+    counters = Counter()
+    timings = params.get('timings')
+    
+    # 進行状況は圧縮後のバイト数で重み付けする（スケジューラーからはブックごとの Progress が渡される）
+    sizes = {fmt: os.path.getsize(path) if path and os.path.exists(path) else 0 for fmt, path in formats_data.items()}
+    progress = notifications if isinstance(notifications, Progress) else Progress(notifications, sum(sizes.values()))
+    offset = 0
+    # キャンセルで途中のフォーマットを残した場合は True（ブックは取り込まない）
+    aborted = False
+
+    for fmt, path in formats_data.items():
+        # 前のフォーマットまでを完了とする（スキップしたフォーマットや途中で失敗したフォーマットを含む）
+        progress.complete(offset)
+        offset += sizes[fmt]
+        if abort and abort.is_set():
+            aborted = True
+            break
+        if not path or not os.path.exists(path): continue
+        
+        if zipfile.is_zipfile(path):
+            old_size = os.path.getsize(path)
+            # staging_dir はライブラリと同じファイルシステム上にあり、取り込み時にコピーせず移動できる
+            fd, temp_out = tempfile.mkstemp(suffix=f'.{fmt.lower()}', dir=staging_dir)
+            os.close(fd)
+            # 前回の出力があれば、変更のない画像はそこからコピーする
+            previous = open_previous((previous_formats or {}).get(fmt)) if params.get('incremental', True) else None
+            manifest = Manifest(params)
+            reused = {}
+            scope = fmt.lower()
+
+            try:
+                with zipfile.ZipFile(path, 'r') as yin, \
+                     zipfile.ZipFile(temp_out, 'w') as yout:
+                    
+                    classifier = EntryClassifier(yin)
+
+                    # EPUB は更新後の OPF と表紙を先に作り、同じパスで書き込む（2回目の書き直しを省く）
+                    embedded = None
+                    try:
+                        with stage(counters, timings, scope, 'metadata'):
+                            embedded = prepare_metadata(yin, book_mi, fmt)
+                    except Exception:
+                        pass  # 従来の方法でもう一度試す（失敗した場合はそこで報告する）
+
+                    def is_image_entry(item):
+                        # OPF の media-type と拡張子で判定し、分からない場合だけ先頭のバイトを読む
+                        with stage(counters, timings, scope, 'classify'):
+                            kind = classifier.classify(item)
+                            if kind is None:
+                                kind = get_image_type(sniff_entry(yin, item)) is not None
+                            return kind
+
+                    def read_entries():
+                        for item in yin.infolist():
+                            # 解凍の途中でユーザーがキャンセルを押したかどうかを確認
+                            if abort and abort.is_set(): break
+                            # これらの特殊ファイルは処理しない（EPUB仕様やCalibre用メタ）
+                            if item.filename in ('calibre_bookmarks.txt', MANIFEST_NAME):
+                                continue
+                            if embedded is not None and item.filename in embedded:
+                                yield item, None, params
+                                continue
+                            prev_item = previous.find(item, manifest.params) if previous else None
+                            if prev_item is not None:
+                                reused[item.filename] = prev_item
+                                yield item, None, params
+                            # 先頭のバイトだけで判定し、画像以外は解凍しない
+                            elif item.filename != 'mimetype' and is_image_entry(item):
+                                with stage(counters, timings, scope, 'zip_inflate', item.file_size):
+                                    data = yin.read(item.filename)
+                                # 拡張子などが画像を示していても、中身が画像でなければそのままコピーする
+                                yield item, data if get_image_type(data[:32]) else None, params
+                            else:
+                                yield item, None, params
+
+                    # 画像はワーカープールで並列に処理し、元のエントリ順で書き戻す
+                    results = map_ordered(optimize_entry, read_entries(), params.get('workers'), abort,
+                                          weigh=entry_memory, budget=memory_budget)
+                    for item, data, is_image, item_counters in results:
+                        counters.update(item_counters)
+                        # 進行状況はエントリの圧縮後のサイズで進め、通知は一定の間隔に間引く
+                        # （メッセージも通知するときだけ組み立てる）
+                        if progress.advance(item.compress_size, 1 if is_image else 0):
+                            progress.update(_("Processing {}: {}").format(fmt, item.filename))
+
+                        if embedded is not None and item.filename in embedded:
+                            with stage(counters, timings, scope, 'metadata'):
+                                yout.writestr(item, embedded.pop(item.filename))
+                        elif is_image:
+                            source = signature(item)
+                            with stage(counters, timings, scope, 'zip_write', len(data)):
+                                yout.writestr(item, data)
+                            manifest.add(item.filename, source, signature(yout.getinfo(item.filename)))
+                        elif item.filename in reused:
+                            prev_item = reused.pop(item.filename)
+                            with stage(counters, timings, scope, 'zip_copy', prev_item.compress_size):
+                                copy_raw(previous.zip, yout, prev_item)
+                            manifest.add(item.filename, signature(item), signature(prev_item))
+                            counters['reused'] += 1
+                        else:
+                            # 圧縮済みのバイト列をそのままストリームでコピーする
+                            with stage(counters, timings, scope, 'zip_copy', item.compress_size):
+                                copy_entry(yin, yout, item)
+
+                    if embedded is not None:
+                        embedded.write_missing(yout, zipfile.ZIP_DEFLATED)
+                    if manifest.entries:
+                        manifest.write(yout)
+
+                # キャンセルされた場合は不完全なファイルを残さない
+                if abort and abort.is_set():
+                    os.remove(temp_out)
+                    aborted = True
+                    break
+
+                # 同じパスで埋め込めなかった場合（EPUB 以外・暗号化された EPUB）は圧縮後にメタデータを埋め込む
+                if embedded is None:
+                    embed_metadata(temp_out, book_mi, fmt, counters, timings, progress, log)
+
+                optimized_formats[fmt] = temp_out
+                stats[fmt] = format_stats(fmt, old_size, temp_out, log)
+            except Exception as e:
+                if log: log.error(_("Error {}: {}").format(fmt, str(e)))
+                if os.path.exists(temp_out): os.remove(temp_out)
+            finally:
+                if previous is not None: previous.close()
+
+        else:
+            # zip 以外（MOBI・AZW3・PDF）は、フォーマットごとのアダプターで画像だけを書き換える
+            adapter = find_adapter(fmt, path)
+            if adapter is None:
+                continue
+            if not adapter.available():
+                if log: log(_("[{}] {} is not installed, skipping").format(fmt, adapter.requirement))
+                continue
+            old_size = os.path.getsize(path)
+            fd, temp_out = tempfile.mkstemp(suffix=f'.{fmt.lower()}', dir=staging_dir)
+            os.close(fd)
+            try:
+                label = _("Processing {}...").format(fmt)
+                if not rewrite(adapter, path, temp_out, params, counters, progress, label, abort, memory_budget):
+                    os.remove(temp_out)
+                    aborted = True
+                    break
+                embed_metadata(temp_out, book_mi, fmt, counters, timings, progress, log)
+                optimized_formats[fmt] = temp_out
+                stats[fmt] = format_stats(fmt, old_size, temp_out, log)
+            except Exception as e:
+                if log: log.error(_("Error {}: {}").format(fmt, str(e)))
+                if os.path.exists(temp_out): os.remove(temp_out)
+
+    # キャンセルされたブックは、完了したフォーマットも含めて一時ファイルを消し、None を返す
+    if aborted:
+        for temp_path in optimized_formats.values():
+            if os.path.exists(temp_path): os.remove(temp_path)
+        return None
+
+    if log and (counters['cache_hits'] or counters['cache_misses']):
+        log(_("Cache: {} hits, {} misses, {:.1f}s encode time saved").format(
+            counters['cache_hits'], counters['cache_misses'], counters['cache_saved_seconds']))
+
+    if log and (counters['skipped'] or counters['kept_original']):
+        log(_("{} images skipped (already optimal), {} kept original (re-encode not smaller)").format(
+            counters['skipped'], counters['kept_original']))
+
+    if log and counters['unsupported_images']:
+        log(_("{} images stored in an unsupported encoding were kept unchanged").format(counters['unsupported_images']))
+
+    if log and counters['too_large']:
+        log(_("{} images too large to process were kept unchanged").format(counters['too_large']))
+
+    if log and (counters['grayscale'] or counters['bilevel']):
+        log(_("{} images converted to grayscale, {} to a small palette").format(counters['grayscale'], counters['bilevel']))
+
+    if log and (counters['lossless_trials'] or counters['lossless_palette'] or counters['lossless_gray'] or counters['animated']):
+        log(_("Lossless: {} images as a palette, {} as grayscale, {} trial encodes, {} animations with all frames").format(
+            counters['lossless_palette'], counters['lossless_gray'], counters['lossless_trials'], counters['animated']))
+
+    if log and counters['quality_searches']:
+        log(_("Quality search: {} images, average quality {:.0f}, {} trial encodes").format(
+            counters['quality_searches'], counters['quality_sum'] / counters['quality_searches'], counters['quality_trials']))
+
+    if log and any(key.startswith('encoder:') for key in counters):
+        log(_("Encoders: {}").format(', '.join(encoder_lines(counters))))
+
+    if log and counters['reused']:
+        log(_("{} images reused from the previous optimized output").format(counters['reused']))
+
+    if log and timings:
+        for line in format_lines(counters):
+            log("    " + line)
+
+    progress.complete(offset)
+    if log and progress.images:
+        log(_("Throughput: {}").format(progress.summary()))
+    progress.update(_("File processing completed."))
+        
+    return book_mi, optimized_formats, stats, params.get('keep_time_import', True), counters
+
+def book_formats(db, book_id):
+    return {f.upper(): db.format_abspath(book_id, f) for f in (db.formats(book_id) or ())}
+
+def book_size(db, book_id):
+    return sum(os.path.getsize(p) for p in book_formats(db, book_id).values() if p and os.path.exists(p))
+
+def load_book(db, book_id):
+    # db は calibre の Cache (db.new_api)。スレッドセーフなのでバックグラウンドから呼べる
+    mi = db.get_metadata(book_id, get_cover=True)
+    # 次回の差分実行で前回の出力を見つけられるよう、元のブックの UUID を識別子として残す
+    mi.set_identifier(SOURCE_IDENTIFIER, mi.uuid)
+    mi.title = f"{mi.title} [optimized]" # Metadataオブジェクトのタイトルを変更
+    return mi, book_formats(db, book_id)
+
+def run_batch(book_ids, params, db, on_batch_done, abort=None, log=None, notifications=None, on_skipped=None):
+    # バッチ全体を1つのジョブとして実行し、同時に処理するブック数とメモリ・一時ディスクを制限する。
+    # 完了したブックはバックグラウンドでまとめて取り込み、on_batch_done([(book_id, new_id, result, error), ...]) を呼ぶ。
+    # 推定削減率が小さくて除いたブックは on_skipped(book_ids) に渡す
+    # メモリ予算はバッチごとに作る（同じプロセスで同時に実行される別のバッチの上限を書き換えない）
+    memory_budget = MemoryBudget(parse_mb(params.get('memory_budget')))
+    scheduler = BookScheduler(do_single_optimization,
+                              books_in_flight=parse_count(params.get('books_in_flight'), 2),
+                              disk_budget=parse_mb(params.get('disk_budget')))
+
+    previous = previous_outputs(db) if params.get('incremental', True) else {}
+
+    # 推定削減率が小さいブックは、標本で見積もってから除く
+    book_ids = filter_books(book_ids, params, db, abort, log, notifications, on_skipped)
+
+    # 途中でディスクがいっぱいにならないよう、開始前に空き容量を確認する
+    staging_dir = create_staging_dir(db.backend.library_path)
+    try:
+        preflight(db, book_ids, staging_dir)
+    except Exception:
+        remove_staging_dir(staging_dir)
+        raise
+
+    # 進行状況はブックの入力サイズで重み付けする
+    sizes = {book_id: book_size(db, book_id) for book_id in book_ids}
+
+    def prepare(book_id):
+        mi, formats_data = load_book(db, book_id)
+        previous_id = previous.get(mi.uuid)
+        previous_formats = book_formats(db, previous_id) if previous_id else None
+        # 出力は入力より大きくならない前提で、入力サイズを一時ディスク使用量の見積もりとする
+        estimate = sum(os.path.getsize(p) for p in formats_data.values() if p and os.path.exists(p))
+        args = (params, db.backend.library_path, mi, formats_data)
+        return (args, {'previous_formats': previous_formats, 'staging_dir': staging_dir,
+                       'memory_budget': memory_budget}), estimate
+
+    ingestor = Ingestor(db, on_batch_done, log)
+    try:
+        failed = scheduler.run(book_ids, prepare, lambda book_id, result: ingestor.submit(book_id, result),
+                               abort, log, notifications, sizes)
+    finally:
+        ingestor.close()
+        remove_staging_dir(staging_dir)
+    failed.extend(ingestor.failed)
+
+    if log and scheduler.progress.images:
+        log(_("Batch throughput: {}").format(scheduler.progress.summary()))
+    if notifications:
+        notifications.put((1.0, _("File processing completed.")))
+    return failed
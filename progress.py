@@ -0,0 +1,110 @@
+import time, threading
+
+from calibre.utils.localization import _
+
+load_translations()  # type: ignore
+
+# 処理済みの圧縮後バイト数で重み付けした進行状況と、処理速度（MB/s・画像/s）・残り時間。
+# バッチ全体の Progress の下にブックごとの子を作り、子の進みは親にも加算する。
+# 通知は UPDATE_INTERVAL ごとに間引くので、小さなエントリが大量にあってもキューがあふれない
+
+# 通知の最小間隔（秒）
+UPDATE_INTERVAL = 0.25
+# 速度を計算する前に待つ時間（開始直後の値は不安定なため、ETA を表示しない）
+WARMUP_SECONDS = 1.0
+
+def format_eta(seconds):
+    if seconds is None:
+        return '--:--'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return '{}:{:02d}'.format(seconds // 60, seconds % 60)
+
+class Progress:
+    def __init__(self, notifications=None, total_bytes=0, parent=None):
+        self.notifications = notifications
+        self.total_bytes = total_bytes
+        self.parent = parent
+        self.done_bytes = 0
+        self.images = 0
+        self.start = time.monotonic()
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def child(self, total_bytes):
+        # ブック1冊分の進行状況（通知は親のキューに送る）
+        return Progress(None, total_bytes, parent=self)
+
+    @property
+    def fraction(self):
+        if not self.total_bytes:
+            return 0.0
+        return min(1.0, self.done_bytes / self.total_bytes)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def rates(self):
+        # (MB/s, 画像/s, 残り秒数)。開始直後は残り時間を None とする
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0, 0.0, None
+        byte_rate = self.done_bytes / elapsed
+        eta = None
+        if elapsed >= WARMUP_SECONDS and byte_rate > 0:
+            eta = max(0, self.total_bytes - self.done_bytes) / byte_rate
+        return byte_rate / 1048576, self.images / elapsed, eta
+
+    def describe(self):
+        mb_s, images_s, eta = self.rates()
+        return _("{:.1f}MB/s, {:.1f} images/s, ETA {}").format(mb_s, images_s, format_eta(eta))
+
+    def advance(self, nbytes, images=0):
+        # 処理した圧縮後のバイト数と画像数を加える。通知する時刻になっていれば True を返す
+        # （メッセージの組み立ては呼び出し側で、通知するときだけ行う）
+        node = self
+        while node is not None:
+            with node._lock:
+                node.done_bytes += nbytes
+                node.images += images
+            node = node.parent
+        return self._due()
+
+    def complete(self, done_bytes):
+        # done_bytes までの部分（フォーマット・ブック）が完了した。エントリの合計と実際のファイルサイズの差
+        # （zip のヘッダーや処理しなかった部分）を加える
+        missing = done_bytes - self.done_bytes
+        if missing > 0:
+            self.advance(missing)
+
+    def _due(self):
+        root = self.parent or self
+        now = time.monotonic()
+        with root._lock:
+            if now - root._last < UPDATE_INTERVAL:
+                return False
+            root._last = now
+            return True
+
+    def update(self, label):
+        # label と、このブック・バッチ全体の速度と残り時間を通知する
+        root = self.parent or self
+        if root.notifications is None:
+            return
+        if self.parent is None:
+            message = _("{} — {}").format(label, self.describe())
+        else:
+            message = _("{} — {} — batch {}").format(label, self.describe(), root.describe())
+        root.notifications.put((root.fraction, message))
+
+    def put(self, update):
+        # 従来の (比率, メッセージ) の通知も受け付ける（比率はバイト数から求めるので使わない）
+        _fraction, message = update
+        self.update(message)
+
+    def summary(self):
+        mb_s, images_s, _eta = self.rates()
+        return _("{:.1f}MB in {:.1f}s ({:.1f}MB/s, {:.1f} images/s)").format(
+            self.done_bytes / 1048576, self.elapsed, mb_s, images_s)
@@ -0,0 +1,151 @@
+import io
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy がない場合は純粋な Python で同じ計算を行う（遅いが結果は同じ）
+    np = None
+
+from .pool import get_trial_pool
+
+# 品質の探索モード
+QUALITY_FIXED = 'fixed'
+QUALITY_SSIM = 'ssim'
+QUALITY_SIZE = 'size'
+QUALITY_MODES = (QUALITY_FIXED, QUALITY_SSIM, QUALITY_SIZE)
+
+# 探索する品質の下限（上限は設定の品質）
+MIN_QUALITY = 30
+# 1回の探索で同時に試すエンコード数と、探索の最大回数
+TRIAL_WIDTH = 3
+MAX_ROUNDS = 3
+
+# SSIM はこのサイズ以下に縮小した輝度で、8x8 のブロックごとに計算する
+SSIM_SIDE = 256
+SSIM_BLOCK = 8
+_C1 = (0.01 * 255) ** 2
+_C2 = (0.03 * 255) ** 2
+
+# 品質パラメータを持つ非可逆フォーマット
+LOSSY_FORMATS = ('JPEG', 'JPG', 'WEBP')
+
+def quality_mode(params):
+    mode = params.get('quality_mode') or QUALITY_FIXED
+    return mode if mode in QUALITY_MODES else QUALITY_FIXED
+
+def parse_target(params, mode):
+    # SSIM は 0-1、サイズは KB 単位。不正な値の場合は None（固定品質として扱う）
+    try:
+        if mode == QUALITY_SSIM:
+            value = float(params.get('target_ssim'))
+            return value if 0 < value < 1 else None
+        if mode == QUALITY_SIZE:
+            value = float(params.get('target_kb'))
+            return int(value * 1024) if value > 0 else None
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def luma_plane(image, size=None):
+    # 比較用の縮小した輝度。size を指定すると参照と同じ大きさにそろえる
+    gray = image.convert('L')
+    if size is None:
+        w, h = gray.size
+        scale = min(1.0, SSIM_SIDE / max(w, h))
+        size = (max(SSIM_BLOCK, int(w * scale)), max(SSIM_BLOCK, int(h * scale)))
+    if gray.size != size:
+        gray = gray.resize(size, Image.Resampling.BOX)
+    return gray
+
+def _block_ssim(a, b):
+    # 1ブロックの統計量から SSIM を計算する
+    n = len(a)
+    ma = sum(a) / n
+    mb = sum(b) / n
+    va = sum(x * x for x in a) / n - ma * ma
+    vb = sum(y * y for y in b) / n - mb * mb
+    cov = sum(x * y for x, y in zip(a, b)) / n - ma * mb
+    return ((2 * ma * mb + _C1) * (2 * cov + _C2)) / ((ma * ma + mb * mb + _C1) * (va + vb + _C2))
+
+def ssim(reference, candidate):
+    # 同じ大きさの 'L' 画像2つの平均 SSIM（端のブロックに満たない部分は無視する）
+    w, h = reference.size
+    bw, bh = w // SSIM_BLOCK, h // SSIM_BLOCK
+    if np is not None:
+        def blocks(plane):
+            a = np.asarray(plane, dtype=np.float64)[:bh * SSIM_BLOCK, :bw * SSIM_BLOCK]
+            return a.reshape(bh, SSIM_BLOCK, bw, SSIM_BLOCK).swapaxes(1, 2).reshape(bh * bw, -1)
+        a, b = blocks(reference), blocks(candidate)
+        ma, mb = a.mean(axis=1), b.mean(axis=1)
+        va, vb = a.var(axis=1), b.var(axis=1)
+        cov = (a * b).mean(axis=1) - ma * mb
+        values = ((2 * ma * mb + _C1) * (2 * cov + _C2)) / ((ma * ma + mb * mb + _C1) * (va + vb + _C2))
+        return float(values.mean())
+
+    ra, ca = reference.tobytes(), candidate.tobytes()
+    total = 0.0
+    for by in range(bh):
+        for bx in range(bw):
+            a, b = [], []
+            for y in range(by * SSIM_BLOCK, (by + 1) * SSIM_BLOCK):
+                start = y * w + bx * SSIM_BLOCK
+                a.extend(ra[start:start + SSIM_BLOCK])
+                b.extend(ca[start:start + SSIM_BLOCK])
+            total += _block_ssim(a, b)
+    return total / (bw * bh)
+
+def _probes(lo, hi):
+    # lo..hi を TRIAL_WIDTH + 1 個の区間に分ける品質（重複なし）
+    step = (hi - lo) / (TRIAL_WIDTH + 1)
+    return sorted({int(round(lo + step * (i + 1))) for i in range(TRIAL_WIDTH)} - {lo, hi})
+
+def search_quality(image, encode, max_quality, mode, target, counters=None):
+    # encode(image, quality) -> bytes。条件を満たす最小の出力になる品質を探し、(品質, bytes) を返す。
+    #   ssim: SSIM が target 以上になる最低の品質
+    #   size: 出力が target バイト以下になる最高の品質
+    # 品質に対して SSIM もサイズも（ほぼ）単調なので、複数の品質を同時にエンコードして範囲を狭める
+    reference = luma_plane(image) if mode == QUALITY_SSIM else None
+    pool = get_trial_pool()
+    results = {}
+
+    def trial(quality):
+        # Image.save は encoderinfo を画像に書き込むので、スレッドごとにコピーを使う
+        data = encode(image.copy(), quality)
+        if reference is None:
+            return data, len(data) <= target
+        with Image.open(io.BytesIO(data)) as decoded:
+            score = ssim(reference, luma_plane(decoded, reference.size))
+        return data, score >= target
+
+    def run(qualities):
+        qualities = [q for q in dict.fromkeys(qualities) if q not in results]
+        for quality, result in zip(qualities, pool.map(trial, qualities)):
+            results[quality] = result
+        if counters is not None: counters['quality_trials'] += len(qualities)
+
+    lo, hi = MIN_QUALITY, max(MIN_QUALITY, max_quality)
+    run([lo, hi])
+    # ssim は高い側、size は低い側が条件を満たす。両端の結果で答えが決まる場合は探索しない
+    good, bad = (hi, lo) if mode == QUALITY_SSIM else (lo, hi)
+    if results[bad][1]:
+        good = bad
+    elif results[good][1]:
+        for _round in range(MAX_ROUNDS):
+            lo, hi = min(good, bad), max(good, bad)
+            probes = _probes(lo, hi)
+            if not probes: break
+            run(probes)
+            for quality in (probes if mode == QUALITY_SSIM else reversed(probes)):
+                if results[quality][1]:
+                    good = quality
+                    break
+            # good に最も近い不合格の品質を bad にする
+            failing = [q for q in results if not results[q][1] and (q < good if mode == QUALITY_SSIM else q > good)]
+            bad = max(failing) if mode == QUALITY_SSIM else min(failing)
+    # 条件を満たす品質がない場合は、ssim は設定の品質、size は最低の品質を使う
+
+    if counters is not None:
+        counters['quality_searches'] += 1
+        counters['quality_sum'] += good
+    return good, results[good][0]
@@ -0,0 +1,142 @@
+import os, threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from calibre.utils.localization import _
+
+from .progress import Progress
+
+load_translations()  # type: ignore
+
+# abort と一時ディスク予算を確認する間隔（秒）
+POLL_INTERVAL = 0.2
+
+def parse_mb(value, default=0):
+    # MB 単位の設定値をバイトに変換する（0 または不正な値は無制限）
+    try:
+        return max(0, int(float(value) * 1024 * 1024))
+    except (TypeError, ValueError):
+        return default
+
+def parse_count(value, default=1):
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        return default
+    return count if count > 0 else default
+
+class BookScheduler:
+    # 1つのバッチ内で同時に処理するブック数と一時ディスク使用量を制限する。
+    # 画像のエンコードは pool.py の共有プールに投入されるので、大小のブックが混在してもコアが遊ばない
+
+    def __init__(self, process, books_in_flight=2, disk_budget=0):
+        self.process = process
+        self.books_in_flight = books_in_flight
+        self.disk_budget = disk_budget
+        self._lock = threading.Lock()
+        self._reserved = {}  # book_id -> 予約した一時ディスク容量
+        self._outputs = []  # 取り込み待ちの一時ファイル
+        # バッチ全体の進行状況（ブックの入力サイズで重み付け）
+        self.progress = Progress()
+
+    def _disk_in_use(self):
+        # 取り込み（削除）済みの一時ファイルは予算から外す
+        self._outputs = [p for p in self._outputs if os.path.exists(p)]
+        used = 0
+        for p in self._outputs:
+            try:
+                used += os.path.getsize(p)
+            except OSError:
+                pass
+        return used + sum(self._reserved.values())
+
+    def _admit(self, book_id, estimate, abort, collect):
+        # 一時ディスク予算に空きができるまで待つ。処理中のブックも取り込み待ちの出力もなければ必ず開始する。
+        # 待っている間も collect() で完了したブックを取り込みに渡す（取り込みスレッドが出力を削除して空きができる）
+        while True:
+            if abort is not None and abort.is_set():
+                return False
+            with self._lock:
+                in_use = self._disk_in_use()
+                if not self.disk_budget or not in_use or in_use + estimate <= self.disk_budget:
+                    self._reserved[book_id] = estimate
+                    return True
+            collect()
+
+    def _run_book(self, book_id, book, size, abort, log):
+        args, kwargs = book
+        # process には各ブックの Progress を notifications として渡す（通知はバッチ全体のキューに送られる）
+        progress = self.progress.child(size)
+        result = None
+        try:
+            result = self.process(book_id, *args, abort=abort, log=log, notifications=progress, **kwargs)
+            return result
+        finally:
+            progress.complete(size)
+            # 予約を外すのと同時に出力ファイルを取り込み待ちに加える（メインスレッドが結果を受け取る前に
+            # 次のブックが開始されても、出力の分を予算に数える）
+            with self._lock:
+                self._reserved.pop(book_id, None)
+                if result is not None:
+                    self._outputs.extend(result[1].values())
+
+    def run(self, book_ids, prepare, on_book_done, abort=None, log=None, notifications=None, sizes=None):
+        # prepare(book_id) -> ((args, kwargs), estimate) は process に渡す引数と一時ディスク見積もりを返す。
+        # 完了したブックの結果は on_book_done(book_id, result) に順次渡す（キャンセルされたブックは渡さない）。
+        # sizes ({book_id: バイト数}) は進行状況の重み。ない場合は見積もりを使い、開始したブックから合計に加える
+        sizes = sizes or {}
+        self.progress = Progress(notifications, sum(sizes.get(book_id, 0) for book_id in book_ids))
+        failed = []
+        pending = {}
+        queue = list(book_ids)
+
+        def collect():
+            # 完了したブックの結果を受け取る（処理中のブックがなければ POLL_INTERVAL だけ待つ）
+            if not pending:
+                if abort is not None:
+                    abort.wait(POLL_INTERVAL)
+                else:
+                    threading.Event().wait(POLL_INTERVAL)
+                return
+            done, _pending = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                book_id = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed.append(book_id)
+                    if log: log.error(_("Error {}: {}").format(book_id, str(e)))
+                    continue
+                # キャンセルで途中まで処理したブック（process が None を返す）は取り込まない
+                if result is None:
+                    continue
+                on_book_done(book_id, result)
+
+        with ThreadPoolExecutor(max_workers=self.books_in_flight, thread_name_prefix='image_optimizer_book') as executor:
+            while queue or pending:
+                while queue and len(pending) < self.books_in_flight:
+                    if abort is not None and abort.is_set():
+                        queue = []
+                        break
+                    book_id = queue[0]
+                    try:
+                        book, estimate = prepare(book_id)
+                    except Exception as e:
+                        queue.pop(0)
+                        failed.append(book_id)
+                        self.progress.total_bytes -= sizes.get(book_id, 0)
+                        if log: log.error(_("Error {}: {}").format(book_id, str(e)))
+                        continue
+                    if not self._admit(book_id, estimate, abort, collect):
+                        queue = []
+                        break
+                    queue.pop(0)
+                    size = sizes.get(book_id)
+                    if size is None:
+                        size = estimate
+                        self.progress.total_bytes += estimate
+                    pending[executor.submit(self._run_book, book_id, book, size, abort, log)] = book_id
+                if not pending:
+                    break
+
+                collect()
+        return failed
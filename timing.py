@@ -0,0 +1,78 @@
+import time, json
+from collections import defaultdict
+
+from calibre.utils.localization import _
+
+load_translations()  # type: ignore
+
+# ステージごとの処理時間と処理バイト数をカウンターに記録する。
+# キーは "time:<対象>:<ステージ>"（対象はブックのフォーマットまたは画像の種類）で、
+# ワーカースレッドのカウンターと同じ経路でメインスレッド・GUI に集計される
+
+STAGES = ('classify', 'zip_inflate', 'decode', 'resize', 'color', 'encode', 'zip_write', 'zip_copy', 'metadata')
+
+class _Stage:
+    __slots__ = ('counters', 'scope', 'name', 'nbytes', 'start')
+
+    def __init__(self, counters, scope, name, nbytes):
+        self.counters = counters
+        self.scope = scope
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        key = '{}:{}'.format(self.scope, self.name)
+        self.counters['time:' + key] += time.perf_counter() - self.start
+        self.counters['bytes:' + key] += self.nbytes
+        self.counters['calls:' + key] += 1
+
+class _NullStage:
+    # 無効時は何もしない（nbytes の代入も受け付ける）
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+def stage(counters, enabled, scope, name, nbytes=0):
+    if not enabled or counters is None:
+        return _NULL_STAGE
+    return _Stage(counters, scope, name, nbytes)
+
+def collect(counters):
+    # {対象: {ステージ: {'seconds', 'bytes', 'calls'}}}
+    result = defaultdict(dict)
+    for key, value in counters.items():
+        kind, sep, rest = key.partition(':')
+        if not sep or kind not in ('time', 'bytes', 'calls'):
+            continue
+        scope, _sep, name = rest.rpartition(':')
+        row = result[scope].setdefault(name, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+        row[{'time': 'seconds', 'bytes': 'bytes', 'calls': 'calls'}[kind]] += value
+    return {scope: dict(sorted(stages.items(), key=lambda s: STAGES.index(s[0]) if s[0] in STAGES else len(STAGES)))
+            for scope, stages in sorted(result.items())}
+
+def to_json(counters):
+    return json.dumps(collect(counters), indent=2, sort_keys=False)
+
+def format_lines(counters):
+    lines = []
+    for scope, stages in collect(counters).items():
+        for name, row in stages.items():
+            if row['bytes']:
+                lines.append(_("{} {}: {:.2f}s, {:.1f}MB, {} calls").format(
+                    scope, name, row['seconds'], row['bytes'] / (1024 * 1024), row['calls']))
+            else:
+                lines.append(_("{} {}: {:.2f}s, {} calls").format(scope, name, row['seconds'], row['calls']))
+    return lines
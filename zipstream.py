@@ -0,0 +1,86 @@
+import copy, shutil, struct, zipfile
+
+# 一度にメモリに載せる最大サイズ
+CHUNK_SIZE = 1024 * 1024
+
+# ローカルファイルヘッダーのファイル名長・拡張フィールド長の位置
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+
+_MASK_ENCRYPTED = 0x01
+_MASK_USE_DATA_DESCRIPTOR = 0x08
+
+def sniff_entry(yin, item, size=32):
+    # エントリ全体を解凍せず、先頭の数バイトだけを読む
+    if item.file_size == 0:
+        return b''
+    with yin.open(item) as f:
+        return f.read(size)
+
+def _can_copy_raw(item):
+    if item.flag_bits & _MASK_ENCRYPTED:
+        return False
+    # ZIP64 拡張フィールドの再構築は zipfile に任せる
+    if item.file_size > zipfile.ZIP64_LIMIT or item.compress_size > zipfile.ZIP64_LIMIT:
+        return False
+    return True
+
+def _data_offset(yin, item):
+    yin.fp.seek(item.header_offset)
+    header = yin.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile('Truncated file header')
+    fheader = struct.unpack(zipfile.structFileHeader, header)
+    if fheader[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile('Bad magic number for file header')
+    return item.header_offset + zipfile.sizeFileHeader + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH]
+
+def copy_raw(yin, yout, item):
+    # 圧縮済みのバイト列をそのままコピーする（解凍・再圧縮を行わない）
+    zinfo = copy.copy(item)
+    # CRC とサイズは既知なので、データディスクリプタは使わずヘッダーに書き込む
+    zinfo.flag_bits &= ~_MASK_USE_DATA_DESCRIPTOR
+
+    # zipfile には生データを書き込む公開 API がないため、ZipFile.write と同じ手順でヘッダーを書く
+    with yin._lock, yout._lock:
+        offset = _data_offset(yin, item)
+        if yout._seekable:
+            yout.fp.seek(yout.start_dir)
+        zinfo.header_offset = yout.fp.tell()
+        yout._writecheck(zinfo)
+        yout._didModify = True
+        yout.fp.write(zinfo.FileHeader(False))
+
+        yin.fp.seek(offset)
+        remaining = item.compress_size
+        while remaining > 0:
+            chunk = yin.fp.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile('Truncated file data: {}'.format(item.filename))
+            yout.fp.write(chunk)
+            remaining -= len(chunk)
+
+        yout.start_dir = yout.fp.tell()
+        yout.filelist.append(zinfo)
+        yout.NameToInfo[zinfo.filename] = zinfo
+
+def copy_stream(yin, yout, item, compress_type):
+    # 解凍しながらチャンク単位で再圧縮する（エントリ全体をメモリに載せない）
+    zinfo = zipfile.ZipInfo(item.filename, date_time=item.date_time)
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = item.external_attr
+    zinfo.create_system = item.create_system
+    zinfo.comment = item.comment
+    zinfo.extra = item.extra
+    zinfo.file_size = item.file_size
+    with yin.open(item) as src, yout.open(zinfo, 'w', force_zip64=item.file_size > zipfile.ZIP64_LIMIT) as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+def copy_entry(yin, yout, item):
+    # mimetype 以外の無圧縮エントリは、これまでどおり DEFLATE で圧縮する
+    if item.compress_type == zipfile.ZIP_STORED and item.filename != 'mimetype':
+        copy_stream(yin, yout, item, zipfile.ZIP_DEFLATED)
+    elif _can_copy_raw(item):
+        copy_raw(yin, yout, item)
+    else:
+        copy_stream(yin, yout, item, item.compress_type)